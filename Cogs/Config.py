@@ -42,6 +42,9 @@ class Config(commands.Cog):
         ).add_field(
             name="Minimum Players",
             value=f"{"No Minimum Players" if not sett.get("minimum_players") else sett['minimum_players']}"
+        ).add_field(
+            name="Fuzzy Matching",
+            value=f"{"Exact Matching" if not sett.get("fuzzy_threshold") else f"Up to {sett['fuzzy_threshold']} characters"}"
         )
 
         view = ConfigurationMenu(self.bot, sett, ctx.author.id)
@@ -64,7 +67,7 @@ class Config(commands.Cog):
                 )
             )
         
-        check = await self.bot.prc_api._send_test_request(ctx.guild.id, key)
+        check = await self.bot.prc_api._send_test_request(key)
         if not check:
             return await ctx.send(
                 embed=discord.Embed(
@@ -80,6 +83,8 @@ class Config(commands.Cog):
         }
 
         await self.bot.settings.update_by_id(doc)
+        # Guilds are only chunked once linked, so chunk this one ahead of its first check.
+        self.bot.spawn(self.bot.chunk_guild(ctx.guild))
 
         message = await ctx.send(
             embed=discord.Embed(
@@ -0,0 +1,39 @@
+from discord.ext import commands
+
+class Members(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.bot.member_index.add(member.guild.id, member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.nick == after.nick:
+            return
+        self.bot.member_index.add(after.guild.id, after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if before.name == after.name and before.global_name == after.global_name:
+            return
+        for guild in after.mutual_guilds:
+            member = guild.get_member(after.id)
+            if member:
+                self.bot.member_index.add(guild.id, member)
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload):
+        # Dispatched for uncached members too, unlike on_member_remove.
+        self.bot.member_index.remove(payload.guild_id, payload.user.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.bot.member_index.forget(guild.id)
+        self.bot.rosters.forget(guild.id)
+        self.bot.alerts.forget(guild.id)
+
+
+async def setup(bot):
+    await bot.add_cog(Members(bot))
@@ -0,0 +1,82 @@
+import hashlib
+
+import aiohttp
+import discord
+from discord.ext import commands
+
+ROBLOX_USERNAMES_URL = "https://users.roblox.com/v1/usernames/users"
+ROBLOX_USER_URL = "https://users.roblox.com/v1/users/{}"
+
+class Verify(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.session = None
+
+    async def cog_load(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+
+    async def cog_unload(self):
+        await self.session.close()
+
+    @staticmethod
+    def verification_code(discord_id, roblox_id):
+        digest = hashlib.sha256(f"{discord_id}:{roblox_id}".encode()).hexdigest()
+        return f"erlc-{digest[:8]}"
+
+    async def fetch_roblox_user(self, username):
+        async with self.session.post(ROBLOX_USERNAMES_URL, json={
+            "usernames": [username],
+            "excludeBannedUsers": True
+        }) as resp:
+            if resp.status != 200:
+                return None
+            data = (await resp.json()).get("data") or []
+        if not data:
+            return None
+
+        async with self.session.get(ROBLOX_USER_URL.format(data[0]["id"])) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.json()
+
+    @commands.guild_only()
+    @commands.hybrid_command()
+    async def verify(self, ctx, username: str):
+        """
+        Link your Roblox account to your Discord account.
+        """
+        user = await self.fetch_roblox_user(username)
+        if user is None:
+            return await ctx.send(
+                embed=discord.Embed(
+                    title="User Not Found",
+                    description="No Roblox user has this username.",
+                    color=0x2F3136
+                )
+            )
+
+        code = self.verification_code(ctx.author.id, user["id"])
+        if code not in (user.get("description") or ""):
+            return await ctx.send(
+                embed=discord.Embed(
+                    title="Verification Required",
+                    description=f"Add `{code}` to the About section of your Roblox profile **{user['name']}**, then run this command again.",
+                    color=0x2F3136
+                )
+            )
+
+        await self.bot.links.verify(user["id"], ctx.author.id)
+        # Players are re-checked against the new link on the next check.
+        self.bot.rosters.forget(ctx.guild.id)
+
+        await ctx.send(
+            embed=discord.Embed(
+                title="Account Verified",
+                description=f"Your Discord account is now linked to **{user['name']}**. You can remove the code from your profile.",
+                color=0x2F3136
+            )
+        )
+
+
+async def setup(bot):
+    await bot.add_cog(Verify(bot))
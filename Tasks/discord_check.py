@@ -1,126 +1,327 @@
 import datetime
-import re
 import time
 import discord
 import pytz
 from discord.ext import tasks
+from decouple import config
 import logging
 import asyncio
 
-from Utils.constants import BLANK_COLOR
 from Utils.prc import ServerPlayers
+from Utils.scheduler import GuildScheduler, fan_out
 from Utils import prc
+from Utils import metrics
 
-@tasks.loop(minutes=2, reconnect=True)
-async def discord_checks(bot):
-    start_time = time.time()
-    logging.warning("[ITERATE] Starting Discord Check Iteration")
-    total_guilds = 0
-    await asyncio.sleep(5)
-    async for guild_data in bot.settings.db.find():
+CHECK_CONCURRENCY = config('CHECK_CONCURRENCY', default=10, cast=int)
+# Minutes between checks of a server with steady activity
+FULL_CHECK_MINUTES = config('FULL_CHECK_MINUTES', default=2, cast=float)
+# Bounds of the interval between checks of a single server
+MIN_CHECK_SECONDS = config('MIN_CHECK_SECONDS', default=30, cast=float)
+MAX_CHECK_MINUTES = config('MAX_CHECK_MINUTES', default=15, cast=float)
+# Maximum number of guild checks started per minute, across all guilds
+CHECK_BUDGET = config('CHECK_BUDGET', default=600, cast=int)
+CHECK_TICK_SECONDS = config('CHECK_TICK_SECONDS', default=5, cast=float)
+RESYNC_MINUTES = config('RESYNC_MINUTES', default=5, cast=float)
+# Seconds between join log polls, 0 disables the incremental mode
+JOINLOG_INTERVAL = config('JOINLOG_INTERVAL', default=0, cast=float)
+DEFAULT_MESSAGE = "You are not in the communication server. Please join it."
+DEFAULT_ESCALATION_MESSAGE = "Final warning: you are still not in the communication server. Join it now."
+SCAN_BATCH_SIZE = config('SCAN_BATCH_SIZE', default=100, cast=int)
+
+# Only guilds with both an API key and an alert channel are checked.
+LINKED_GUILDS = {"api_key": {"$exists": True}, "alert_channel": {"$exists": True}}
+
+scheduler = GuildScheduler(FULL_CHECK_MINUTES * 60, MIN_CHECK_SECONDS, MAX_CHECK_MINUTES * 60, CHECK_BUDGET)
+check_semaphore = asyncio.Semaphore(CHECK_CONCURRENCY)
+running_checks = set()
+last_sync = float("-inf")
+joinlog_lock = asyncio.Lock()
+# guild ID -> (timestamp of the newest join log entry seen, IDs of the players seen joining in that second)
+joinlog_watermarks = {}
+# guild ID -> monotonic time of the last join log poll
+joinlog_polled_at = {}
+
+
+async def resolve_guild(bot, guild_id, fuzzy=False):
+    """
+    Get a guild from the gateway cache, making sure its members are available.
+    :param bot (Bot): The bot.
+    :param guild_id (int): The ID of the guild.
+    :param fuzzy (bool): Whether the guild uses fuzzy matching.
+    :return (discord.Guild): The guild, or None if it cannot be checked.
+    """
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        # Only hit the API on a cache miss, to tell a guild the bot left apart from a cache gap.
         try:
-            guild_id = guild_data["guild_id"] or guild_data["_id"]
-            
-            try:
-                guild = await bot.fetch_guild(guild_id)
-            except discord.errors.NotFound:
-                logging.warning(f"[ITERATE] Guild with ID {guild_id} not found")
-                continue
+            await bot.fetch_guild(guild_id)
+        except (discord.errors.NotFound, discord.errors.Forbidden):
+            if guild_id not in scheduler.departed:
+                logging.warning(f"[ITERATE] Guild with ID {guild_id} not found, checking it every {MAX_CHECK_MINUTES} minutes")
+            scheduler.departed.add(guild_id)
+            return None
+        logging.warning(f"[ITERATE] Guild with ID {guild_id} is not cached yet, skipping")
+        return None
+    scheduler.departed.discard(guild_id)
+    bot.member_index.use_fuzzy(guild_id, fuzzy)
+
+    try:
+        # Chunks the guild if it has not been chunked since its shard was ready.
+        await bot.chunk_guild(guild)
+    except asyncio.TimeoutError:
+        logging.warning(f"[ITERATE] Timed out chunking the members of guild {guild_id}, skipping")
+        return None
+    if not bot.member_index.is_indexed(guild_id):
+        return None
+    return guild
+
+
+async def warn_players(bot, guild_id, guild_data, not_in_discord):
+    """
+    Warn players in-game that they are not in the Discord server.
+    Players warned within the cooldown are skipped, and players warned too
+    many times already get the escalation message instead.
+    :param bot (Bot): The bot.
+    :param guild_id (int): The ID of the guild.
+    :param guild_data (dict): The settings document of the guild.
+    :param not_in_discord (dict): Roblox user ID -> name of the players to warn.
+    """
+    warnings = {}
+    escalations = {}
+    for player_id, player_name in not_in_discord.items():
+        bot.warnings.seen(guild_id, player_id)
+        if bot.warnings.escalated(guild_id, player_id):
+            escalations[player_id] = player_name
+        else:
+            warnings[player_id] = player_name
+
+    queued = bot.dispatcher.enqueue(guild_id, warnings, guild_data.get("message", DEFAULT_MESSAGE))
+    if escalations:
+        queued += bot.dispatcher.enqueue(
+            guild_id, escalations, guild_data.get("escalation_message", DEFAULT_ESCALATION_MESSAGE)
+        )
+    sent = await bot.dispatcher.flush(guild_id)
+    logging.info(f"[ITERATE] Sent {sent} commands to {queued} players in guild {guild_id}, {len(escalations)} escalated")
+
+
+async def check_guild(bot, guild_data):
+    """
+    Check the players of a single guild's private server against its Discord members.
+    :param bot (Bot): The bot.
+    :param guild_data (dict): The settings document of the guild.
+    :return (bool): Whether the guild was checked.
+    """
+    guild_id = int(guild_data.get("guild_id") or guild_data["_id"])
+    with metrics.CHECK_DURATION.time(guild_id):
+        try:
+            guild = await resolve_guild(bot, guild_id, guild_data.get("fuzzy_threshold", 0) > 0)
+            if guild is None:
+                return False
 
             try:
                 players: list[ServerPlayers] = await bot.prc_api._fetch_server_players(guild_id)
-            except prc.ResponseFailed:
-                logging.error(f"[ITERATE] PRC ResponseFailure for guild {guild_id}")
-                continue
-                
+            except prc.ServerLinkNotFound:
+                logging.warning(f"[ITERATE] No API key linked for guild {guild_id}")
+                return False
+            except prc.ResponseFailed as e:
+                logging.error(f"[ITERATE] PRC ResponseFailure for guild {guild_id}: {e.code} {e.detail}")
+                return False
+
             logging.info(f"[ITERATE] Checking {len(players)} players in guild {guild_id}")
 
+            roster = await bot.rosters.check(guild.id, players, guild_data.get("fuzzy_threshold", 0))
+            logging.info(f"[ITERATE] Guild {guild_id}: {roster.joined} joined, {roster.left} left, {roster.checked} matched")
+            # Stats are kept out of the settings, so checks do not invalidate the cached settings.
+            bot.check_stats.queue_update(guild_id, {
+                "$set": {
+                    "checked_at": datetime.datetime.now(pytz.utc),
+                    "players": len(players),
+                    "missing": len(roster.missing)
+                },
+                "$inc": {"check_count": 1}
+            })
+
             total_players = len(players)
             minimum_players = guild_data.get("minimum_players", 0)
             if total_players < minimum_players:
                 logging.warning(f"[ITERATE] Not enough players in guild {guild_id} ({total_players}/{minimum_players})")
-                continue
+                return False
+
+            alert_channel = guild.get_channel(guild_data.get("alert_channel"))
+            if alert_channel is None:
+                logging.warning(f"[ITERATE] Alert channel not found in guild {guild_id}")
+
+            await warn_players(bot, guild_id, guild_data, roster.missing)
 
             try:
-                alert_channel = guild.get_channel(guild_data["alert_channel"])
+                if alert_channel:
+                    # Edits the status message of the guild, only if the missing players changed
+                    await bot.alerts.update(guild, alert_channel, roster.missing, guild_data)
+            except discord.errors.Forbidden:
+                logging.warning(f"[ITERATE] Missing permissions to send messages in guild {guild_id}")
             except discord.errors.NotFound:
                 logging.warning(f"[ITERATE] Alert channel not found in guild {guild_id}")
+            except discord.errors.HTTPException:
+                logging.warning(f"[ITERATE] Failed to send message in guild {guild_id}")
 
-            embed = discord.Embed(
-                title="Players Not in Discord",
-                color=BLANK_COLOR,
-                timestamp=datetime.datetime.now(pytz.utc),
-            )
-            embed.description = ""
+        except Exception as e:
+            logging.error(f"[ITERATE] Error in guild {guild_id}: {e}")
+            return False
 
-            not_in_discord = []
+        return True
 
-            import unicodedata
 
-            def normalize_name(name):
-                """Removes prefixes, special characters, and converts to lowercase."""
-                # Remove everything before the first letter/number
-                name = re.sub(r'^[^a-zA-Z0-9]+', '', name)
-                # Remove remaining special characters and convert to lowercase
-                return re.sub(r'[^a-zA-Z0-9]', '', name).lower()
+async def check_join_logs(bot, guild_data):
+    """
+    Check the players who joined a guild's private server since the last poll of its join logs.
+    :param bot (Bot): The bot.
+    :param guild_data (dict): The settings document of the guild.
+    :return (int): The number of new joins checked.
+    """
+    guild_id = int(guild_data.get("guild_id") or guild_data["_id"])
+    try:
+        guild = await resolve_guild(bot, guild_id, guild_data.get("fuzzy_threshold", 0) > 0)
+        if guild is None:
+            return 0
 
+        try:
+            logs = await bot.prc_api._fetch_server_join_logs(guild_id)
+        except (prc.ServerLinkNotFound, prc.ResponseFailed):
+            return 0
 
-            for player in players:
-                player_name = normalize_name(player.Player.split(":")[0])  # Clean the player name
-                player_id = player.Player.split(":")[1]
+        if guild_id in joinlog_watermarks:
+            watermark, seen = joinlog_watermarks[guild_id]
+        else:
+            # Only read once per process, the watermark is kept in memory afterwards.
+            stats = await bot.check_stats.find_by_id(guild_id) or {}
+            watermark, seen = stats.get("joinlog_watermark"), set(stats.get("joinlog_seen", ()))
+        stored = (watermark, seen)
 
-                member_found = False
+        def joined_at(timestamp):
+            return {log.user_id for log in logs if log.Join and log.Timestamp == timestamp and log.user_id is not None}
 
-                for member in guild.members:
-                    discord_names = {
-                        normalize_name(member.name),
-                        normalize_name(member.display_name),
-                        normalize_name(getattr(member, 'global_name', '') or '')
-                    }
+        latest = max((log.Timestamp for log in logs), default=watermark or 0)
+        if watermark is None:
+            # First poll of this guild: older joins are covered by the full check.
+            watermark, seen = latest, joined_at(latest)
 
-                    # Check for an **exact match** instead of partial match
-                    if player_name in discord_names:
-                        member_found = True
-                        break
+        # Timestamps are in whole seconds: a join in the same second as the watermark, made after the
+        # previous poll, is only told apart from the ones already seen by its player.
+        joins = [
+            log for log in logs
+            if log.Join and log.user_id is not None
+            and (log.Timestamp > watermark or (log.Timestamp == watermark and log.user_id not in seen))
+        ]
+        latest_seen = joined_at(latest) | (seen if latest == watermark else set())
+        if (latest, latest_seen) != stored:
+            bot.check_stats.queue_update(guild_id, {"$set": {
+                "joinlog_watermark": latest,
+                "joinlog_seen": sorted(latest_seen)
+            }})
+        joinlog_watermarks[guild_id] = (latest, latest_seen)
 
-                if not member_found:
-                    embed.description += f"> [{player_name}](https://roblox.com/users/{player_id}/profile)\n"
-                    not_in_discord.append(player_name)
+        if not joins:
+            return 0
 
+        minimum_players = guild_data.get("minimum_players", 0)
+        if bot.rosters.player_count(guild_id) < minimum_players:
+            return len(joins)
 
+        not_in_discord = await bot.rosters.find_missing(
+            guild.id, {log.user_id: log.name for log in joins}, guild_data.get("fuzzy_threshold", 0)
+        )
 
-            if embed.description == "":
-                embed.description = "> All players are in the Discord server."
+        logging.info(f"[JOINLOG] {len(joins)} new joins in guild {guild_id}, {len(not_in_discord)} not in Discord")
+        await warn_players(bot, guild_id, guild_data, not_in_discord)
+        return len(joins)
 
-            embed.set_author(
-                name=guild.name,
-                icon_url=guild.icon
-            )
+    except Exception as e:
+        logging.error(f"[JOINLOG] Error in guild {guild_id}: {e}")
+        return 0
 
-            if not_in_discord:
-                message = f":pm {','.join(not_in_discord)} {guild_data['message']}"
-                #await bot.prc_api._send_command(guild_id, message)
-            logging.info(f"[ITERATE] Sent command to {len(not_in_discord)} players in guild {guild_id}")
 
-            try:
-                if alert_channel:
-                    #await alert_channel.send(embed=embed)
-                    pass
-            except discord.errors.Forbidden:
-                logging.warning(f"[ITERATE] Missing permissions to send messages in guild {guild_id}")
-            except discord.errors.NotFound:
-                logging.warning(f"[ITERATE] Alert channel not found in guild {guild_id}")
-            except discord.errors.HTTPException:
-                logging.warning(f"[ITERATE] Failed to send message in guild {guild_id}")
+async def sync_guilds(bot):
+    """
+    Refresh the scheduled guilds from the linked guilds in the settings.
+    :param bot (Bot): The bot.
+    """
+    start_time = time.time()
+    keys = {}
+    async for guild_data in bot.settings.iter(bot.settings_query(LINKED_GUILDS), {"guild_id": 1}, SCAN_BATCH_SIZE):
+        keys[int(guild_data.get("guild_id") or guild_data["_id"])] = guild_data["_id"]
+    scheduler.sync(keys)
+    metrics.GUILDS_SCHEDULED.set(len(keys))
+    logging.warning(f"[ITERATE] Scheduling {len(keys)} guilds, {scheduler.backlog} overdue, synced in {time.time() - start_time} seconds")
 
-        except Exception as e:
-            logging.error(f"[ITERATE] Error in guild {guild_id}: {e}")
-            continue
 
-        total_guilds += 1
-        await asyncio.sleep(2)  # Using asyncio.sleep instead of time.sleep
+async def run_check(bot, guild_id):
+    """
+    Check a guild and schedule its next check.
+    :param bot (Bot): The bot.
+    :param guild_id (int): The ID of the guild.
+    """
+    start = time.monotonic()
+    guild_data = None
+    try:
+        async with check_semaphore:
+            guild_data = await bot.settings.get(scheduler.keys.get(guild_id, guild_id))
+            if guild_data:
+                await check_guild(bot, guild_data)
+    finally:
+        players, joined, checked_at = bot.rosters.activity(guild_id)
+        if checked_at is None or checked_at < start:
+            # The check failed before reaching the server, so there is no fresh activity.
+            players = None
+        scheduler.done(guild_id, players, joined, (guild_data or {}).get("minimum_players", 0))
+
+
+@tasks.loop(seconds=CHECK_TICK_SECONDS, reconnect=True)
+async def discord_checks(bot):
+    global last_sync
+    await bot.cache_ready.wait()
+
+    if time.monotonic() - last_sync >= RESYNC_MINUTES * 60:
+        await sync_guilds(bot)
+        last_sync = time.monotonic()
+
+    due = scheduler.pop_due()
+    for guild_id, overdue in due:
+        metrics.CHECK_DELAY.observe(overdue)
+        task = asyncio.create_task(run_check(bot, guild_id))
+        running_checks.add(task)
+        task.add_done_callback(running_checks.discard)
+
+    metrics.CHECK_BACKLOG.set(scheduler.backlog)
+    if due:
+        logging.info(f"[ITERATE] Started {len(due)} guild checks, {len(running_checks)} running")
+
+
+@tasks.loop(seconds=max(JOINLOG_INTERVAL, 1), reconnect=True)
+async def join_log_checks(bot):
+    if joinlog_lock.locked():
+        return
+
+    async with joinlog_lock:
+        await bot.cache_ready.wait()
+        # Polls go through the same request budget as the checks, least recently polled guilds first.
+        # Guilds the bot left are only looked up by their full checks.
+        polled = sorted(scheduler.keys.keys() - scheduler.departed, key=lambda guild_id: joinlog_polled_at.get(guild_id, 0))
+        guild_ids = polled[:scheduler.spend(len(polled))]
+
+        async def scheduled_guilds():
+            for guild_id in guild_ids:
+                joinlog_polled_at[guild_id] = time.monotonic()
+                guild_data = await bot.settings.get(scheduler.keys.get(guild_id, guild_id))
+                if guild_data:
+                    yield guild_data
 
-    end_time = time.time()
-    logging.warning(f"[ITERATE] Discord Check Iteration finished in {end_time - start_time} seconds")
-    logging.warning(f"[ITERATE] Next Discord Check Iteration in 2 minutes")
-    logging.warning(f"[ITERATE] Checked {total_guilds} guilds")
\ No newline at end of file
+        results = await fan_out(
+            scheduled_guilds(),
+            lambda guild_data: check_join_logs(bot, guild_data),
+            CHECK_CONCURRENCY
+        )
+        total_joins = sum(result for result in results if isinstance(result, int))
+        if total_joins:
+            logging.info(f"[JOINLOG] Checked {total_joins} new joins")
+        if len(guild_ids) < len(polled):
+            logging.info(f"[JOINLOG] Polled {len(guild_ids)}/{len(polled)} guilds within the check budget")
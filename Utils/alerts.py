@@ -0,0 +1,153 @@
+import datetime
+import logging
+
+import discord
+import pytz
+
+from Utils.constants import BLANK_COLOR
+from Utils.ratelimit import RateLimiter
+
+
+"""
+This module contains the AlertSink class, which keeps one live status message
+per guild in its alert channel. The message is edited in place, and only when
+the players not in the Discord server change, instead of posting a new embed
+on every check. Edits go through a per-channel rate limiter, and a guild whose
+edit is still waiting for the limiter only has its latest state published.
+"""
+
+# Discord message limits
+DESCRIPTION_LIMIT = 4096
+EMBEDS_LIMIT = 10
+TOTAL_LIMIT = 6000
+
+TITLE = "Players Not in Discord"
+
+
+class AlertState:
+    __slots__ = ("channel_id", "message_id", "signature")
+
+    def __init__(self, channel_id, message_id=None, signature=None):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.signature = signature
+
+
+def render(guild, missing):
+    """
+    Build the embeds listing the players not in the Discord server.
+    Players are spread over as many embeds as the limits of a single message
+    allow, and the ones that do not fit are counted in the footer.
+    :param guild (discord.Guild): The guild.
+    :param missing (dict): Roblox user ID -> name of the players not in the Discord server.
+    :return (list[discord.Embed]): The embeds.
+    """
+    footer = f"{len(missing)} players not in Discord"
+    # Title, author and footer count towards the limit of the message
+    budget = TOTAL_LIMIT - len(TITLE) - len(guild.name) - len(footer) - 32
+
+    descriptions = [""]
+    shown = 0
+    for player_id, player_name in missing.items():
+        line = f"> [{player_name}](https://roblox.com/users/{player_id}/profile)\n"
+        if len(line) > budget:
+            break
+        if len(descriptions[-1]) + len(line) > DESCRIPTION_LIMIT:
+            if len(descriptions) == EMBEDS_LIMIT:
+                break
+            descriptions.append("")
+        descriptions[-1] += line
+        budget -= len(line)
+        shown += 1
+
+    if not missing:
+        descriptions = ["> All players are in the Discord server."]
+    elif shown < len(missing):
+        footer += f", {len(missing) - shown} not shown"
+
+    timestamp = datetime.datetime.now(pytz.utc)
+    embeds = []
+    for description in descriptions:
+        embeds.append(discord.Embed(color=BLANK_COLOR, description=description))
+    embeds[0].title = TITLE
+    embeds[0].set_author(name=guild.name, icon_url=guild.icon)
+    embeds[-1].set_footer(text=footer)
+    embeds[-1].timestamp = timestamp
+    return embeds
+
+
+class AlertSink:
+    def __init__(self, settings, rate=0.2, capacity=1, global_rate=10.0, global_capacity=10):
+        """
+        A class to publish the players not in the Discord server to alert channels.
+        :param settings (Document): The settings, where the ID of each status message is kept.
+        :param rate (float): The number of edits per second allowed per channel.
+        :param capacity (int): The burst of edits allowed per channel.
+        :param global_rate (float): The number of edits per second allowed across all channels.
+        :param global_capacity (int): The burst of edits allowed across all channels.
+        """
+        self.settings = settings
+        self.limiter = RateLimiter(rate, capacity, global_rate, global_capacity)
+        # guild_id -> AlertState of the published status message
+        self._states = {}
+        # guild_id -> (channel, signature, embeds, settings ID) waiting for the limiter
+        self._pending = {}
+        # IDs of the guilds whose status message is being published
+        self._sending = set()
+        self.logger = logging.getLogger(__name__)
+
+    def forget(self, guild_id):
+        """
+        Drop the state of a guild.
+        :param guild_id (int): The ID of the guild.
+        """
+        self._states.pop(guild_id, None)
+        self._pending.pop(guild_id, None)
+
+    async def update(self, guild, channel, missing, guild_data):
+        """
+        Publish the players not in the Discord server, if they changed since the last update.
+        :param guild (discord.Guild): The guild.
+        :param channel (discord.TextChannel): The alert channel.
+        :param missing (dict): Roblox user ID -> name of the players not in the Discord server.
+        :param guild_data (dict): The settings document of the guild.
+        :return (bool): Whether the status message was changed.
+        """
+        signature = frozenset(missing)
+        state = self._states.get(guild.id)
+        if state is None:
+            # The message posted before a restart is edited instead of posting a new one.
+            state = self._states[guild.id] = AlertState(channel.id, guild_data.get("alert_message_id"))
+        if state.signature == signature and state.channel_id == channel.id and guild.id not in self._pending:
+            return False
+
+        self._pending[guild.id] = (channel, signature, render(guild, missing), guild_data["_id"])
+        if guild.id in self._sending:
+            # The update already waiting for the limiter publishes this state instead.
+            return True
+
+        self._sending.add(guild.id)
+        try:
+            while guild.id in self._pending:
+                await self.limiter.acquire(self._pending[guild.id][0].id)
+                channel, signature, embeds, settings_id = self._pending.pop(guild.id)
+                await self._publish(guild.id, channel, signature, embeds, settings_id)
+        finally:
+            self._sending.discard(guild.id)
+        return True
+
+    async def _publish(self, guild_id, channel, signature, embeds, settings_id):
+        state = self._states.setdefault(guild_id, AlertState(channel.id))
+        if state.message_id is not None and state.channel_id == channel.id:
+            try:
+                await channel.get_partial_message(state.message_id).edit(embeds=embeds)
+                state.signature = signature
+                return
+            except discord.errors.NotFound:
+                self.logger.info(f"Status message of guild {guild_id} was deleted, posting a new one")
+
+        message = await channel.send(embeds=embeds)
+        state.channel_id = channel.id
+        state.message_id = message.id
+        state.signature = signature
+        self.settings.queue_update(settings_id, {"$set": {"alert_message_id": message.id}}, upsert=False)
@@ -0,0 +1,73 @@
+import collections
+import time
+
+
+"""
+This module contains the TTLCache class, a small in-memory cache with a time
+to live and a maximum size, evicting the least recently used entries first.
+"""
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, ttl, maxsize):
+        """
+        A class to represent a TTL + LRU bounded cache.
+        :param ttl (float): The number of seconds an entry is kept.
+        :param maxsize (int): The maximum number of entries kept.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=MISSING):
+        """
+        Get an entry from the cache.
+        :param key (hashable): The key of the entry.
+        :param default: The value returned if the entry is missing or expired.
+        :return: The cached value, or `default`.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Add or replace an entry in the cache.
+        :param key (hashable): The key of the entry.
+        :param value: The value to cache.
+        """
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove an entry from the cache.
+        :param key (hashable): The key of the entry.
+        """
+        self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        self._data.clear()
@@ -0,0 +1,62 @@
+"""
+This module contains the helpers used to split guilds between worker
+processes. Discord assigns a guild to shard `(guild_id >> 22) % shard_count`,
+so each worker only connects to, caches and checks the guilds of its own
+shards.
+"""
+
+def shard_for_guild(guild_id, shard_count):
+    """
+    Get the shard of a guild.
+    :param guild_id (int): The ID of the guild.
+    :param shard_count (int): The total number of shards.
+    :return (int): The shard ID of the guild.
+    """
+    return (int(guild_id) >> 22) % shard_count
+
+
+def shard_ranges(shard_count, workers):
+    """
+    Split shards into contiguous ranges, one per worker.
+    :param shard_count (int): The total number of shards.
+    :param workers (int): The number of workers.
+    :return (list[list[int]]): The shard IDs of each worker.
+    """
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def shard_query(shard_ids, shard_count):
+    """
+    Build a MongoDB filter matching the settings documents of guilds in some shards.
+    Documents are keyed by guild ID, or by a string `guild_id` field for older ones.
+    The shift is done as exact integer arithmetic: `id - id % 2**22` has at most
+    41 significant bits, so dividing it by 2**22 as a double loses nothing.
+    :param shard_ids (list[int]): The shard IDs.
+    :param shard_count (int): The total number of shards.
+    :return (dict): The filter.
+    """
+    guild_id = {
+        "$convert": {
+            "input": {"$ifNull": ["$guild_id", "$_id"]},
+            "to": "long",
+            "onError": 0,
+            "onNull": 0
+        }
+    }
+    shifted = {
+        "$toLong": {
+            "$divide": [
+                {"$subtract": [guild_id, {"$mod": [guild_id, 4194304]}]},
+                4194304
+            ]
+        }
+    }
+    return {"$expr": {"$in": [{"$mod": [shifted, shard_count]}, list(shard_ids)]}}
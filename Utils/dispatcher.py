@@ -0,0 +1,110 @@
+import asyncio
+import logging
+
+from Utils import prc
+
+
+"""
+This module contains the CommandDispatcher class, which queues in-game
+`:pm` warnings per server, drops warnings for players still within their
+cooldown in the warning history, and sends them as few commands as
+possible, each kept under the maximum command length.
+"""
+
+# Roblox usernames are at most 20 characters long
+MAX_NAME_LENGTH = 20
+
+class CommandDispatcher:
+    def __init__(self, prc_api, history, max_length=200):
+        """
+        A class to batch in-game warnings per server.
+        :param prc_api (PRC_API_Client): The client used to send the commands.
+        :param history (WarningHistory): The warning history, which sent warnings are recorded in.
+        :param max_length (int): The maximum length of a single command.
+        """
+        self.prc_api = prc_api
+        self.history = history
+        self.max_length = max_length
+        # guild_id -> message -> player name -> Roblox user ID, in the order they were queued
+        self._pending = {}
+        self._locks = {}
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def max_message_length(self):
+        """
+        The maximum length of a warning message, so a command warning one player always fits.
+        """
+        return self.max_length - len(":pm  ") - MAX_NAME_LENGTH
+
+    def enqueue(self, guild_id, players, message):
+        """
+        Queue a warning for players of a server.
+        Players already queued, or warned within the cooldown, are skipped.
+        :param guild_id (int): The ID of the guild.
+        :param players (dict): Roblox user ID -> name of the players to warn.
+        :param message (str): The warning message.
+        :return (int): The number of players queued.
+        """
+        queue = self._pending.setdefault(guild_id, {}).setdefault(message, {})
+        queued = 0
+        for player_id, name in players.items():
+            if name in queue or not self.history.due(guild_id, player_id):
+                continue
+            queue[name] = player_id
+            queued += 1
+        return queued
+
+    def chunk(self, names, message):
+        """
+        Split the players of a warning into batches whose command fits in the maximum length.
+        :param names (list[str]): The names of the players to warn.
+        :param message (str): The warning message.
+        :return (list[list[str]]): The batches of player names.
+        """
+        batches = []
+        batch = []
+        # ":pm " + names joined by "," + " " + message
+        base = len(":pm ") + 1 + len(message)
+        length = base
+        for name in names:
+            if base + len(name) > self.max_length:
+                self.logger.warning(f"Skipped warning {name}: the command would exceed {self.max_length} characters")
+                continue
+            extra = len(name) + (1 if batch else 0)
+            if batch and length + extra > self.max_length:
+                batches.append(batch)
+                batch = []
+                length = base
+                extra = len(name)
+            batch.append(name)
+            length += extra
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def flush(self, guild_id):
+        """
+        Send every queued warning of a server.
+        Commands go through the PRC client, and so through its rate limiter.
+        :param guild_id (int): The ID of the guild.
+        :return (int): The number of commands sent.
+        """
+        lock = self._locks.setdefault(guild_id, asyncio.Lock())
+        async with lock:
+            pending = self._pending.pop(guild_id, {})
+            sent = 0
+            for message, queue in pending.items():
+                # A flush of the same guild may have warned these players while this one waited for the lock.
+                names = [name for name, player_id in queue.items() if self.history.due(guild_id, player_id)]
+                for batch in self.chunk(names, message):
+                    try:
+                        await self.prc_api._send_command(guild_id, f":pm {','.join(batch)} {message}")
+                    except (prc.ResponseFailed, prc.ServerLinkNotFound) as e:
+                        # Players left unwarned are queued again on the next check.
+                        self.logger.warning(f"Failed to send warning command in guild {guild_id}: {e}")
+                        return sent
+                    for name in batch:
+                        self.history.warned(guild_id, queue[name])
+                    sent += 1
+            return sent
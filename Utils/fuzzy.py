@@ -0,0 +1,122 @@
+import heapq
+from array import array
+from collections import Counter
+
+try:
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    Levenshtein = None
+
+
+"""
+This module contains the n-gram index used for approximate name matching.
+Words within an edit distance k of a query share most of its n-grams: each
+edit changes at most n of them. The index maps each n-gram to the IDs of the
+words containing it, so a lookup counts the n-grams each word shares with the
+query and only computes the edit distance of the best candidates. Postings are
+arrays of word IDs, compact in memory and cheap to send back from the process
+pool. The distance is computed by rapidfuzz when it is installed, and in pure
+Python otherwise.
+"""
+
+GRAM_LENGTH = 2
+# Pads words so their first and last letters get n-grams of their own.
+PAD = "\0"
+
+
+def levenshtein(a, b, limit=None):
+    """
+    Compute the edit distance between two strings.
+    :param a (str): The first string.
+    :param b (str): The second string.
+    :param limit (int): Stop early and return `limit + 1` once the distance exceeds it.
+    :return (int): The edit distance.
+    """
+    if Levenshtein is not None:
+        return Levenshtein.distance(a, b, score_cutoff=limit)
+
+    if a == b:
+        return 0
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    if not b:
+        return len(a)
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def ngrams(word):
+    """
+    Get the distinct n-grams of a word.
+    :param word (str): The word.
+    :return (set[str]): The n-grams.
+    """
+    padded = f"{PAD}{word}{PAD}"
+    return {padded[i:i + GRAM_LENGTH] for i in range(len(padded) - GRAM_LENGTH + 1)}
+
+
+def index_words(words, first_id=0, postings=None):
+    """
+    Add words to the postings of an n-gram index.
+    Runs in a worker process for large guilds, so it only takes and returns plain containers.
+    :param words (list[str]): The words, each added once, with consecutive IDs.
+    :param first_id (int): The ID of the first word.
+    :param postings (dict): The postings to add to, new ones if not given.
+    :return (dict): n-gram -> array of the IDs of the words containing it.
+    """
+    if postings is None:
+        postings = {}
+    for word_id, word in enumerate(words, first_id):
+        for gram in ngrams(word):
+            ids = postings.get(gram)
+            if ids is None:
+                postings[gram] = array('I', (word_id,))
+            else:
+                ids.append(word_id)
+    return postings
+
+
+def candidates(postings, vocabulary, word, max_distance, limit, live=None):
+    """
+    Find the words of an n-gram index which may be within an edit distance of a word.
+    :param postings (dict): The postings of the index.
+    :param vocabulary (list[str]): The words of the index, by ID.
+    :param word (str): The word.
+    :param max_distance (int): The maximum edit distance.
+    :param limit (int): The maximum number of candidates.
+    :param live (dict): The words still in the index, if removed words may remain in the postings.
+    :return (list[str]): The candidates, sharing the most n-grams with the word first.
+    """
+    grams = ngrams(word)
+    # Each edit changes at most GRAM_LENGTH of the n-grams of the word.
+    needed = max(1, len(grams) - GRAM_LENGTH * max_distance)
+
+    counts = Counter()
+    for gram in grams:
+        ids = postings.get(gram)
+        if ids:
+            counts.update(ids)
+
+    found = []
+    length = len(word)
+    for word_id, count in counts.items():
+        if count < needed:
+            continue
+        candidate = vocabulary[word_id]
+        if abs(len(candidate) - length) <= max_distance and (live is None or candidate in live):
+            found.append((count, candidate))
+    return [candidate for count, candidate in heapq.nlargest(limit, found)]
@@ -0,0 +1,121 @@
+import datetime
+import logging
+
+import pytz
+
+from Utils.cache import TTLCache
+
+
+"""
+This module contains the LinkStore class, which maps Roblox user IDs to
+Discord user IDs. Links are kept in memory for O(1) lookups and persisted to
+a MongoDB collection. Verified links come from the verify command and hold in
+every guild. Unambiguous exact name matches are recorded as links too, so a
+player is resolved by ID on later checks even after renaming; as a name match
+is only as good as the names of one guild, these links only hold in the guild
+they were matched in, and expire after a retention period, in memory and
+through a TTL index.
+"""
+
+VERIFIED = "verified"
+MATCHED = "matched"
+
+
+class LinkStore:
+    def __init__(self, document, retention=30 * 86400, maxsize=200000):
+        """
+        A class to represent the Roblox to Discord link store.
+        :param document (Document): The collection links are persisted to.
+        :param retention (float): The number of seconds a link matched by name is kept.
+        :param maxsize (int): The maximum number of links matched by name kept in memory.
+        """
+        self.document = document
+        self.retention = retention
+        # roblox ID -> discord ID, verified links only
+        self._links = {}
+        # (guild_id, roblox ID) -> discord ID, links matched by name
+        self._matches = TTLCache(retention, maxsize)
+        self.logger = logging.getLogger(__name__)
+
+    def __len__(self):
+        return len(self._links) + len(self._matches)
+
+    @staticmethod
+    def _match_id(guild_id, roblox_id):
+        return f"{guild_id}:{roblox_id}"
+
+    async def load(self, query=None):
+        """
+        Load every verified link, and the links matched by name, from the database.
+        :param query (dict): The query to match the links matched by name to load, all of them if not given.
+        """
+        async for link in self.document.db.find({"source": VERIFIED}, {"discord_id": 1}):
+            self._links[link["_id"]] = link["discord_id"]
+
+        # Name matches recorded before they were scoped to a guild have no guild_id and are left to expire.
+        matched = dict(query or {})
+        matched.update({"source": MATCHED, "guild_id": {"$exists": True}})
+        async for link in self.document.iter(matched, {"guild_id": 1, "roblox_id": 1, "discord_id": 1}):
+            self._matches.set((link["guild_id"], link["roblox_id"]), link["discord_id"])
+        self.logger.info(f"Loaded {len(self._links)} verified and {len(self._matches)} matched Roblox links")
+
+    def get(self, guild_id, roblox_id):
+        """
+        Get the Discord user linked to a Roblox user in a guild.
+        Verified links take precedence over the links matched by name in the guild.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID.
+        :return (int): The Discord user ID, or None if the Roblox user is not linked.
+        """
+        discord_id = self._links.get(roblox_id)
+        if discord_id is not None:
+            return discord_id
+        return self._matches.get((guild_id, roblox_id), None)
+
+    def is_verified(self, roblox_id):
+        """
+        Check if the link of a Roblox user was verified.
+        :param roblox_id (int): The Roblox user ID.
+        :return (bool): Whether the link was verified.
+        """
+        return roblox_id in self._links
+
+    def confirm(self, guild_id, roblox_id, discord_id):
+        """
+        Record a Roblox user matched to a single Discord member of a guild by name.
+        Name matches are not recorded for verified users.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID.
+        :param discord_id (int): The Discord user ID.
+        """
+        if roblox_id in self._links or self._matches.get((guild_id, roblox_id), None) == discord_id:
+            return
+        self._matches.set((guild_id, roblox_id), discord_id)
+        self.document.queue_update(self._match_id(guild_id, roblox_id), {"$set": {
+            "guild_id": guild_id,
+            "roblox_id": roblox_id,
+            "discord_id": discord_id,
+            "source": MATCHED,
+            "linked_at": datetime.datetime.now(pytz.utc)
+        }})
+
+    async def verify(self, roblox_id, discord_id):
+        """
+        Record a link verified by the Discord user.
+        :param roblox_id (int): The Roblox user ID.
+        :param discord_id (int): The Discord user ID.
+        """
+        self._links[roblox_id] = discord_id
+        self.document.queue_update(roblox_id, {"$set": {
+            "discord_id": discord_id,
+            "source": VERIFIED,
+            "linked_at": datetime.datetime.now(pytz.utc)
+        }})
+        await self.document.flush()
+
+    async def flush(self):
+        """
+        Persist the links confirmed by name matches that are not written yet.
+        They are otherwise written in batches by the write-behind of the document.
+        """
+        await self.document.flush()
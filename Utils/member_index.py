@@ -0,0 +1,624 @@
+import asyncio
+import re
+import logging
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain
+from operator import itemgetter
+
+from Utils.fuzzy import candidates, index_words, levenshtein
+
+
+"""
+This module contains the MemberNameIndex class, which keeps a per-guild
+lookup of normalized member names to member IDs. It is built once per guild
+and kept up to date from gateway events, so matching a player against the
+Discord server is a single dictionary lookup instead of a scan over every
+member.
+
+The index only keeps what matching needs. The members of a guild are held
+in parallel arrays, their IDs in an array of integers and their interned
+names in a list, rather than as an object each; names map back to member
+IDs, with a set only for the rare names shared by several members. Name
+tokens are only kept for the guilds using fuzzy matching. In lean
+mode, discord.py does not cache members at all and this index is the only
+member store; it is built from a chunk request made without caching, and
+rebuilt periodically since nickname updates of uncached members are not
+dispatched.
+"""
+
+_LEADING = re.compile(r'^[^a-zA-Z0-9]+')
+_SPECIAL = re.compile(r'[^a-zA-Z0-9]')
+_WORDS = re.compile(r'[^a-zA-Z0-9]+')
+MIN_TOKEN_LENGTH = 3
+# The distinct normalized names a member can have: username, display name and global name.
+NAME_SLOTS = 3
+
+
+def normalize_name(name):
+    """
+    Removes prefixes, special characters, and converts to lowercase.
+    :param name (str): The name to normalize.
+    :return (str): The normalized name.
+    """
+    if not name:
+        return ''
+    # Remove everything before the first letter/number
+    name = _LEADING.sub('', name)
+    # Remove remaining special characters and convert to lowercase
+    return _SPECIAL.sub('', name).lower()
+
+
+def normalize_member(name, display_name, global_name, tokens=True):
+    """
+    Normalize the names of a member.
+    Tokens are the words of the raw names (e.g. "johndoe" in "1A-23 | JohnDoe"),
+    which fuzzy matching uses to see past callsigns and tags.
+    :param name (str): The username of the member.
+    :param display_name (str): The display name of the member.
+    :param global_name (str): The global name of the member.
+    :param tokens (bool): Whether to compute the tokens, only needed for fuzzy matching.
+    :return (tuple): The distinct, non-empty normalized names and the distinct tokens of the member.
+    """
+    names = {normalize_name(name), normalize_name(display_name), normalize_name(global_name)}
+    names.discard('')
+    if not tokens:
+        return tuple(names), ()
+    tokens = set()
+    for raw in (name, display_name, global_name):
+        if raw:
+            tokens.update(token.lower() for token in _WORDS.split(raw) if len(token) >= MIN_TOKEN_LENGTH)
+    tokens -= names
+    return tuple(names), tuple(tokens)
+
+
+def member_names(member, tokens=True):
+    """
+    Get the normalized names of a member.
+    :param member (discord.Member): The member.
+    :param tokens (bool): Whether to compute the tokens, only needed for fuzzy matching.
+    :return (tuple): The distinct, non-empty normalized names and the distinct tokens of the member.
+    """
+    return normalize_member(member.name, member.display_name, getattr(member, 'global_name', None), tokens)
+
+
+def normalize_members(rows, tokens=True):
+    """
+    Normalize the names of many members at once.
+    Runs in a worker process for large guilds, so it only takes and returns plain tuples.
+    :param rows (list[tuple]): (member ID, name, display name, global name) of each member.
+    :param tokens (bool): Whether to compute the tokens, only needed for fuzzy matching.
+    :return (list[tuple]): (member ID, (normalized names, tokens)) of each member.
+    """
+    return [(row[0], normalize_member(row[1], row[2], row[3], tokens)) for row in rows]
+
+
+def fuzzy_distance(name, threshold):
+    """
+    Get the edit distance allowed when fuzzy matching a name.
+    Short names get a smaller distance, so "al" doesn't match every 3 letter name.
+    :param name (str): The normalized name.
+    :param threshold (int): The edit distance configured for the guild.
+    :return (int): The edit distance allowed.
+    """
+    return min(threshold, max(0, (len(name) - 1) // 3))
+
+
+def _intern(words):
+    return tuple(sys.intern(word) for word in words)
+
+
+def _link(index, name, member_id):
+    ids = index.get(name)
+    if ids is None:
+        index[name] = member_id
+    elif isinstance(ids, set):
+        ids.add(member_id)
+    elif ids != member_id:
+        index[name] = {ids, member_id}
+
+
+def _unlink(index, name, member_id):
+    ids = index.get(name)
+    if ids is None:
+        return
+    if isinstance(ids, set):
+        ids.discard(member_id)
+        if len(ids) == 1:
+            index[name] = next(iter(ids))
+    elif ids == member_id:
+        del index[name]
+
+
+class MemberStore:
+    __slots__ = ("ids", "names", "tokens")
+
+    def __init__(self, normalized=(), tokens=False):
+        """
+        A class to represent the members of a guild in the name index.
+        Members are kept in parallel arrays sorted by ID: their IDs in an
+        array of integers, and their names in a list of interned strings
+        with NAME_SLOTS slots per member, padded with None.
+        :param normalized (iterable): (member ID, (normalized names, tokens)) of each member.
+        :param tokens (bool): Whether the tokens of the members are kept, for fuzzy matching.
+        """
+        self.ids = array('Q')
+        self.names = []
+        # member position -> interned tokens of that member, None when the guild does not use fuzzy matching
+        self.tokens = [] if tokens else None
+        for member_id, (names, member_tokens) in sorted(normalized, key=itemgetter(0)):
+            if self.ids and self.ids[-1] == member_id:
+                self._delete(len(self.ids) - 1)
+            self._insert(len(self.ids), member_id, names, member_tokens)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, member_id):
+        return self._find(member_id) is not None
+
+    def _find(self, member_id):
+        i = bisect_left(self.ids, member_id)
+        return i if i < len(self.ids) and self.ids[i] == member_id else None
+
+    def _insert(self, i, member_id, names, tokens):
+        self.ids.insert(i, member_id)
+        start = i * NAME_SLOTS
+        self.names[start:start] = names + (None,) * (NAME_SLOTS - len(names))
+        if self.tokens is not None:
+            self.tokens.insert(i, tokens)
+
+    def _delete(self, i):
+        start = i * NAME_SLOTS
+        names = tuple(name for name in self.names[start:start + NAME_SLOTS] if name is not None)
+        del self.names[start:start + NAME_SLOTS]
+        del self.ids[i]
+        tokens = self.tokens.pop(i) if self.tokens is not None else ()
+        return names, tokens
+
+    def add(self, member_id, names, tokens):
+        """
+        Add or replace a member.
+        :param member_id (int): The ID of the member.
+        :param names (tuple[str]): The interned normalized names of the member.
+        :param tokens (tuple[str]): The interned tokens of the member, ignored if tokens are not kept.
+        :return (tuple): The names and tokens of the member replaced, empty if it was not in the store.
+        """
+        replaced = self.remove(member_id)
+        self._insert(bisect_left(self.ids, member_id), member_id, names, tokens)
+        return replaced
+
+    def remove(self, member_id):
+        """
+        Remove a member.
+        :param member_id (int): The ID of the member.
+        :return (tuple): The names and tokens of the member, empty if it was not in the store.
+        """
+        i = self._find(member_id)
+        if i is None:
+            return (), ()
+        return self._delete(i)
+
+    def words(self):
+        """
+        Get the names and tokens of every member, once per member using them.
+        :return (iterable[str]): The words.
+        """
+        names = filter(None, self.names)
+        if self.tokens is None:
+            return names
+        return chain(names, chain.from_iterable(self.tokens))
+
+
+class FuzzyIndex:
+    __slots__ = ("postings", "vocabulary", "words", "ready")
+
+    def __init__(self, words):
+        """
+        A class to represent the fuzzy matching state of a guild.
+        The vocabulary and postings are only appended to, so they can be
+        searched from a thread while gateway events update them; removed words
+        stay in them until the index is rebuilt and are skipped on search, and
+        words added back are indexed again.
+        :param words (iterable[str]): The names and tokens of every member, once per member using them.
+        """
+        # word -> number of members using it, counted without a Python loop as guilds can be large
+        self.words = dict(Counter(words))
+        # word ID -> word
+        self.vocabulary = list(self.words)
+        self.postings = {}
+        # Resolved once the postings of the vocabulary above are built.
+        self.ready = asyncio.get_running_loop().create_future()
+        self.ready.add_done_callback(lambda future: future.exception())
+
+    def add(self, words):
+        for word in words:
+            count = self.words.get(word, 0)
+            self.words[word] = count + 1
+            if not count:
+                self.vocabulary.append(word)
+                index_words((word,), len(self.vocabulary) - 1, self.postings)
+
+    def merge(self, postings):
+        for gram, ids in postings.items():
+            known = self.postings.get(gram)
+            if known is None:
+                self.postings[gram] = ids
+            else:
+                known.extend(ids)
+
+    def remove(self, words):
+        for word in words:
+            count = self.words.get(word, 0) - 1
+            if count > 0:
+                self.words[word] = count
+            else:
+                self.words.pop(word, None)
+
+    @property
+    def stale(self):
+        return len(self.vocabulary) > 2 * len(self.words) + 100
+
+    def search(self, name, max_distance, limit):
+        for word in candidates(self.postings, self.vocabulary, name, max_distance, limit, self.words):
+            if levenshtein(name, word, max_distance) <= max_distance:
+                return word
+        return None
+
+
+class MemberNameIndex:
+    def __init__(self, executor=None, threshold=20000, lean=False, refresh=0, max_candidates=50):
+        """
+        A class to represent the normalized member name index of every guild.
+        :param executor (concurrent.futures.Executor): The process pool large guilds are indexed in, if any.
+        :param threshold (int): The member count from which a guild is indexed in the process pool and searched in a thread.
+        :param lean (bool): Whether members are fetched by the index instead of read from discord.py's member cache.
+        :param refresh (float): The number of seconds after which the index of a guild is rebuilt, 0 to never rebuild it.
+        :param max_candidates (int): The maximum number of names whose edit distance is computed per fuzzy lookup.
+        """
+        self.executor = executor
+        self.threshold = threshold
+        self.lean = lean
+        self.refresh = refresh
+        self.max_candidates = max_candidates
+        # guild_id -> (member events received while the guild is being indexed, future of the build)
+        self._building = {}
+        # guild_id -> time the index of that guild was built
+        self._built_at = {}
+        # guild_id -> normalized name -> member ID, or set of member IDs sharing that name
+        self._names = {}
+        # guild_id -> MemberStore
+        self._members = {}
+        # IDs of the guilds using fuzzy matching, whose member tokens are kept
+        self._fuzzy_guilds = set()
+        # guild_id -> FuzzyIndex, only for guilds using fuzzy matching
+        self._fuzzy = {}
+        # guild_id -> number of changes made to the index of that guild
+        self._versions = {}
+        self.logger = logging.getLogger(__name__)
+
+    def is_indexed(self, guild_id):
+        """
+        Check if a guild has been indexed.
+        :param guild_id (int): The ID of the guild.
+        :return (bool): Whether the guild has been indexed.
+        """
+        return guild_id in self._members
+
+    def version(self, guild_id):
+        """
+        Get the version of the index of a guild, which changes whenever a member is added, updated or removed.
+        :param guild_id (int): The ID of the guild.
+        :return (int): The version of the index.
+        """
+        return self._versions.get(guild_id, 0)
+
+    def _bump(self, guild_id):
+        self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+
+    def use_fuzzy(self, guild_id, enabled):
+        """
+        Set whether a guild uses fuzzy matching, and so whether the tokens of its members are kept.
+        Tokens are computed from the raw names, so enabling it rebuilds the
+        index of the guild on its next `ensure`; disabling it drops them.
+        :param guild_id (int): The ID of the guild.
+        :param enabled (bool): Whether the guild uses fuzzy matching.
+        """
+        if enabled:
+            self._fuzzy_guilds.add(guild_id)
+        elif guild_id in self._fuzzy_guilds:
+            self._fuzzy_guilds.discard(guild_id)
+            self._fuzzy.pop(guild_id, None)
+            members = self._members.get(guild_id)
+            if members is not None:
+                members.tokens = None
+
+    def _missing_tokens(self, guild_id):
+        return guild_id in self._fuzzy_guilds and self._members[guild_id].tokens is None
+
+    def build(self, guild_id, members):
+        """
+        Build the index of a guild from scratch.
+        :param guild_id (int): The ID of the guild.
+        :param members (iterable): The members of the guild.
+        """
+        tokens = guild_id in self._fuzzy_guilds
+        self._load(guild_id, ((member.id, member_names(member, tokens)) for member in members), tokens)
+
+    async def ensure(self, guild):
+        """
+        Build the index of a guild if it has not been built yet, or is due for a refresh.
+        Guilds whose member list has not been chunked are not indexed, as
+        their member list is incomplete; in lean mode, the members are
+        chunked here without being cached. Guilds above the size threshold
+        are normalized in the process pool, keeping the event loop free.
+        :param guild (discord.Guild): The guild.
+        """
+        building = self._building.get(guild.id)
+        if building is not None:
+            # Another check is already indexing this guild; wait for it, and fail if it fails.
+            # Shielded, so a waiter timing out does not cancel the build for everyone else.
+            await asyncio.shield(building[1])
+            return
+
+        if self.is_indexed(guild.id) and not self._expired(guild.id) and not self._missing_tokens(guild.id):
+            return
+        if not self.lean and not guild.chunked:
+            return
+
+        loop = asyncio.get_running_loop()
+        events, future = self._building[guild.id] = ([], loop.create_future())
+        # Waiters get the failure of the build; without waiters, it is not reported again.
+        future.add_done_callback(lambda future: future.exception())
+        try:
+            members = await guild.chunk(cache=False) if self.lean else guild.members
+            if self.executor is None or len(members) < self.threshold:
+                self.build(guild.id, members)
+            else:
+                tokens = guild.id in self._fuzzy_guilds
+                rows = [(m.id, m.name, m.display_name, getattr(m, 'global_name', None)) for m in members]
+                normalized = await loop.run_in_executor(self.executor, normalize_members, rows, tokens)
+                self._load(guild.id, normalized, tokens)
+        except asyncio.CancelledError:
+            self._building.pop(guild.id, None)
+            # The build was cancelled, usually by the chunk timeout: waiters time out with it.
+            future.set_exception(asyncio.TimeoutError(f"Indexing guild {guild.id} was cancelled"))
+            raise
+        except Exception as e:
+            self._building.pop(guild.id, None)
+            future.set_exception(e)
+            raise
+        self._building.pop(guild.id, None)
+
+        # Replay the member events received while the members were fetched or normalized.
+        for event, value in events:
+            if event == 'add':
+                self.add(guild.id, value)
+            else:
+                self.remove(guild.id, value)
+        future.set_result(None)
+
+    def _expired(self, guild_id):
+        return self.refresh > 0 and time.monotonic() - self._built_at.get(guild_id, 0) > self.refresh
+
+    def _built(self, guild_id):
+        self._built_at[guild_id] = time.monotonic()
+        self._bump(guild_id)
+        if self.lean:
+            self.logger.info(
+                f"Indexed {len(self._members[guild_id])} members in guild {guild_id} "
+                f"({self.memory_usage(guild_id) / 1024:.0f} KiB)"
+            )
+        else:
+            self.logger.info(f"Indexed {len(self._members[guild_id])} members in guild {guild_id}")
+
+    def _load(self, guild_id, normalized, tokens):
+        names = {}
+        interned = []
+        for member_id, (normalized_names, member_tokens) in normalized:
+            normalized_names = _intern(normalized_names)
+            interned.append((member_id, (normalized_names, _intern(member_tokens))))
+            for name in normalized_names:
+                _link(names, name, member_id)
+        self._names[guild_id] = names
+        self._members[guild_id] = MemberStore(interned, tokens)
+        self._fuzzy.pop(guild_id, None)
+        self._built(guild_id)
+
+    def add(self, guild_id, member):
+        """
+        Add or refresh a member in the index of a guild.
+        :param guild_id (int): The ID of the guild.
+        :param member (discord.Member): The member.
+        """
+        if guild_id in self._building:
+            self._building[guild_id][0].append(('add', member))
+        members = self._members.get(guild_id)
+        if members is None:
+            # The guild is indexed lazily on its first check.
+            return
+
+        self._discard(guild_id, member.id)
+
+        names, tokens = member_names(member, members.tokens is not None)
+        names, tokens = _intern(names), _intern(tokens)
+        self._bump(guild_id)
+        members.add(member.id, names, tokens)
+        index = self._names[guild_id]
+        for name in names:
+            _link(index, name, member.id)
+
+        fuzzy = self._fuzzy.get(guild_id)
+        if fuzzy is not None:
+            fuzzy.add(names + tokens)
+
+    def remove(self, guild_id, member_id):
+        """
+        Remove a member from the index of a guild.
+        :param guild_id (int): The ID of the guild.
+        :param member_id (int): The ID of the member.
+        """
+        if guild_id in self._building:
+            self._building[guild_id][0].append(('remove', member_id))
+        self._discard(guild_id, member_id)
+
+    def _discard(self, guild_id, member_id):
+        members = self._members.get(guild_id)
+        if members is None:
+            return
+
+        names, tokens = members.remove(member_id)
+        if names or tokens:
+            self._bump(guild_id)
+
+        fuzzy = self._fuzzy.get(guild_id)
+        if fuzzy is not None:
+            fuzzy.remove(names + tokens)
+
+        index = self._names[guild_id]
+        for name in names:
+            _unlink(index, name, member_id)
+
+    def forget(self, guild_id):
+        """
+        Drop the index of a guild.
+        :param guild_id (int): The ID of the guild.
+        """
+        self._names.pop(guild_id, None)
+        self._members.pop(guild_id, None)
+        self._fuzzy.pop(guild_id, None)
+        self._fuzzy_guilds.discard(guild_id)
+        self._built_at.pop(guild_id, None)
+        self._bump(guild_id)
+
+    def member_count(self):
+        """
+        Get the number of members indexed across every guild.
+        :return (int): The number of members.
+        """
+        return sum(len(members) for members in self._members.values())
+
+    def memory_usage(self, guild_id=None):
+        """
+        Estimate the memory held by the index of a guild, or of every guild.
+        Strings shared between guilds are counted once.
+        :param guild_id (int): The ID of the guild, every guild if not given.
+        :return (int): The number of bytes.
+        """
+        guild_ids = [guild_id] if guild_id is not None else list(self._members)
+        seen = set()
+        size = 0
+
+        def sizeof(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+
+        for guild_id in guild_ids:
+            members = self._members.get(guild_id)
+            if members is None:
+                continue
+            names = self._names[guild_id]
+            size += sizeof(members) + sizeof(members.ids) + sizeof(members.names) + sizeof(names)
+            size += sum(sizeof(name) for name in filter(None, members.names))
+            if members.tokens is not None:
+                size += sizeof(members.tokens)
+                for tokens in members.tokens:
+                    size += sizeof(tokens) + sum(sizeof(token) for token in tokens)
+            # Member IDs or sets of member IDs
+            size += sum(sizeof(ids) for ids in names.values())
+        return size
+
+    def has_member(self, guild_id, member_id):
+        """
+        Check if a member is in the index of a guild.
+        :param guild_id (int): The ID of the guild.
+        :param member_id (int): The ID of the member.
+        :return (bool): Whether the member is in the guild.
+        """
+        return member_id in self._members.get(guild_id, ())
+
+    def lookup(self, guild_id, name):
+        """
+        Find the members of a guild matching a normalized name.
+        :param guild_id (int): The ID of the guild.
+        :param name (str): The normalized name.
+        :return (set): The IDs of the matching members.
+        """
+        ids = self._names.get(guild_id, {}).get(name)
+        if ids is None:
+            return set()
+        return ids if isinstance(ids, set) else {ids}
+
+    def contains(self, guild_id, name):
+        """
+        Check if any member of a guild matches a normalized name.
+        :param guild_id (int): The ID of the guild.
+        :param name (str): The normalized name.
+        :return (bool): Whether a member matches.
+        """
+        return name in self._names.get(guild_id, {})
+
+    def _discard_fuzzy(self, guild_id, fuzzy):
+        if self._fuzzy.get(guild_id) is fuzzy:
+            del self._fuzzy[guild_id]
+
+    async def _fuzzy_index(self, guild_id):
+        fuzzy = self._fuzzy.get(guild_id)
+        if fuzzy is not None and not fuzzy.stale:
+            # Another check may still be building it.
+            await asyncio.shield(fuzzy.ready)
+            return fuzzy
+
+        members = self._members[guild_id]
+        # Registered before its postings are built, so member events received meanwhile are not lost.
+        fuzzy = self._fuzzy[guild_id] = FuzzyIndex(members.words())
+        try:
+            if self.executor is None or len(members) < self.threshold:
+                fuzzy.merge(index_words(fuzzy.vocabulary))
+            else:
+                loop = asyncio.get_running_loop()
+                # Words added meanwhile are appended after the vocabulary sent, so IDs do not collide.
+                fuzzy.merge(await loop.run_in_executor(self.executor, index_words, fuzzy.vocabulary[:]))
+        except asyncio.CancelledError:
+            self._discard_fuzzy(guild_id, fuzzy)
+            fuzzy.ready.set_exception(asyncio.TimeoutError(f"Fuzzy indexing of guild {guild_id} was cancelled"))
+            raise
+        except Exception as e:
+            self._discard_fuzzy(guild_id, fuzzy)
+            fuzzy.ready.set_exception(e)
+            raise
+        fuzzy.ready.set_result(None)
+        return fuzzy
+
+    async def matches(self, guild_id, names, threshold):
+        """
+        Find the normalized names matching a member of a guild within an edit
+        distance of one of their names or name tokens.
+        The fuzzy index of a guild is built on its first lookup, in the process
+        pool for guilds above the size threshold, which are also searched in a
+        thread so the event loop stays free.
+        :param guild_id (int): The ID of the guild.
+        :param names (iterable[str]): The normalized names, not matching any member exactly.
+        :param threshold (int): The maximum edit distance.
+        :return (set[str]): The names matching a member.
+        """
+        names = [name for name in names if fuzzy_distance(name, threshold) > 0]
+        if not names or guild_id not in self._members:
+            return set()
+
+        fuzzy = await self._fuzzy_index(guild_id)
+
+        def search():
+            return {
+                name for name in names
+                if fuzzy.search(name, fuzzy_distance(name, threshold), self.max_candidates) is not None
+            }
+
+        if len(self._members.get(guild_id, ())) >= self.threshold:
+            return await asyncio.to_thread(search)
+        return search()
@@ -0,0 +1,272 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+from aiohttp import web
+
+
+"""
+This module contains a small metrics registry exposed over HTTP in the
+Prometheus text exposition format. Metrics are module-level so any part of
+the bot can record to them without passing the registry around.
+"""
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        A class to represent a metric with optional labels.
+        :param name (str): The name of the metric.
+        :param documentation (str): The help text of the metric.
+        :param labels (tuple): The names of the labels of the metric.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}")
+        return tuple(str(label) for label in labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, *labels):
+        """
+        Set the counter from a count kept elsewhere, which must only ever increase.
+        :param value (int): The count.
+        :param labels: The values of the labels of the counter.
+        """
+        self._values[self._key(labels)] = value
+
+    def expose(self):
+        lines = self.header()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        self._values[self._key(labels)] = value
+
+    def expose(self):
+        lines = self.header()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # bucket counts, sum, count
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """
+        Observe the time spent in a block.
+        :param labels: The values of the labels of the observation.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def expose(self):
+        lines = self.header()
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """
+        A class to hold every metric and the callbacks refreshing them on scrape.
+        """
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        """
+        Add a callback run before every scrape, to refresh gauges from live state.
+        :param collector (callable): The callback.
+        """
+        self.collectors.append(collector)
+
+    def expose(self):
+        """
+        Render every metric in the text exposition format.
+        :return (str): The metrics.
+        """
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                logging.getLogger(__name__).exception("Metrics collector failed")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CHECK_DURATION = Histogram(
+    "erlc_check_guild_duration_seconds", "Time spent checking a single guild.", ("guild_id",)
+)
+CHECK_DELAY = Histogram(
+    "erlc_check_schedule_delay_seconds", "How late guild checks start after they are due.",
+    buckets=(0.1, 1, 5, 10, 30, 60, 120, 300, 600)
+)
+GUILDS_SCHEDULED = Gauge(
+    "erlc_check_guilds_scheduled", "Number of linked guilds in the check schedule."
+)
+CHECK_BACKLOG = Gauge(
+    "erlc_check_backlog", "Number of guild checks that are due but not started yet."
+)
+PRC_REQUEST_DURATION = Histogram(
+    "erlc_prc_request_duration_seconds", "Latency of PRC API requests.", ("endpoint", "status")
+)
+MONGO_OPERATION_DURATION = Histogram(
+    "erlc_mongo_operation_duration_seconds", "Latency of MongoDB operations.", ("collection", "operation")
+)
+CACHE_REQUESTS = Counter(
+    "erlc_cache_requests_total", "Number of cache lookups since startup.", ("cache", "result")
+)
+CACHE_SIZE = Gauge(
+    "erlc_cache_size", "Number of entries held by a cache.", ("cache",)
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    "erlc_http_pool_connections", "Number of connections of the PRC API connection pool.", ("state",)
+)
+MEMBERS_INDEXED = Gauge(
+    "erlc_members_indexed", "Number of members in the name index, across every guild."
+)
+LOOP_LAG = Histogram(
+    "erlc_event_loop_lag_seconds", "Delay of the event loop in running a scheduled callback.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+
+def register_cache(name, cache):
+    """
+    Report the hit rate and size of a TTLCache.
+    :param name (str): The name of the cache in the metrics.
+    :param cache (TTLCache): The cache.
+    """
+    def collect():
+        CACHE_REQUESTS.set(cache.hits, name, "hit")
+        CACHE_REQUESTS.set(cache.misses, name, "miss")
+        CACHE_SIZE.set(len(cache), name)
+    REGISTRY.add_collector(collect)
+
+
+def register_http_pool(client):
+    """
+    Report the utilization of the connection pool of the PRC API client.
+    :param client (PRC_API_Client): The client.
+    """
+    def collect():
+        for state, value in client.pool_stats().items():
+            HTTP_POOL_CONNECTIONS.set(value, state)
+    REGISTRY.add_collector(collect)
+
+
+async def monitor_loop_lag(interval=1.0):
+    """
+    Measure how late the event loop wakes up from a sleep, forever.
+    :param interval (float): The number of seconds between two measurements.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+class MetricsServer:
+    def __init__(self, host, port):
+        """
+        A class to serve the metrics over HTTP on /metrics.
+        :param host (str): The host to listen on.
+        :param port (int): The port to listen on.
+        """
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._lag_task = None
+
+    async def _metrics(self, request):
+        return web.Response(text=REGISTRY.expose(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.create_task(monitor_loop_lag())
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -1,6 +1,15 @@
+import asyncio
 import collections
 import collections.abc
+import functools
 import logging
+import time
+
+import pymongo
+import pymongo.errors
+
+from Utils.cache import TTLCache, MISSING
+from Utils import metrics
 
 
 
@@ -10,6 +19,43 @@ This module contains the MongoDB class, which is a wrapper around the
 to interact with a MongoDB database.
 """
 
+# Error codes of change streams that are not supported, and of resume tokens that cannot be resumed from
+CHANGE_STREAM_UNSUPPORTED = 40573
+CHANGE_STREAM_NOT_RESUMABLE = (260, 280, 286)
+# Error code of an index created again with different options
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def timed(func):
+    """
+    Record the latency of a Document operation.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            metrics.MONGO_OPERATION_DURATION.observe(time.perf_counter() - start, self.db.name, func.__name__)
+    return wrapper
+
+
+def _merge_update(target, update):
+    """
+    Merge an update into an earlier update of the same document.
+    `$inc` amounts add up, other operators keep the latest value of each field.
+    :param target (dict): The earlier update, modified in place.
+    :param update (dict): The later update.
+    """
+    for operator, fields in update.items():
+        merged = target.setdefault(operator, {})
+        if operator == '$inc':
+            for field, value in fields.items():
+                merged[field] = merged.get(field, 0) + value
+        else:
+            merged.update(fields)
+
+
 class Document:
     def __init__(self,connection,document_name):
         """
@@ -20,7 +66,14 @@ class Document:
         """
         self.db = connection[document_name]
         self.logger = logging.getLogger(__name__)
+        # document ID -> [update, upsert] waiting for the next flush
+        self._queued = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._size_flush = None
+        self.max_queued = 0
 
+    @timed
     async def find(self, query):
         """
         Find documents in the database that match the query.
@@ -29,6 +82,7 @@ class Document:
         """
         return await self.db.find(query).to_list(None)
     
+    @timed
     async def find_one(self, query):
         """
         Find a document in the database that matches the query.
@@ -37,6 +91,7 @@ class Document:
         """
         return await self.db.find_one(query)
 
+    @timed
     async def insert_one(self, document):
         """
         Insert a document into the database.
@@ -47,6 +102,7 @@ class Document:
         
         await self.db.insert_one(document)
 
+    @timed
     async def update(self, query, update):
         """
         Update a document in the database.
@@ -56,16 +112,11 @@ class Document:
         if not isinstance(query, collections.abc.Mapping):
             raise TypeError('query must be a dictionary')
 
-        # Check if the document exists
-        existing_doc = await self.db.find_one(query)
-        
-        if existing_doc:
-            # Update the existing document
-            await self.db.update_one(query, {'$set': update})
-        else:
-            # If it doesn't exist, you might want to raise an error or handle it
+        result = await self.db.update_one(query, {'$set': update})
+        if result.matched_count == 0:
             raise ValueError('Document does not exist, cannot update.')
     
+    @timed
     async def find_by_id(self, id):
         """
         Find a document by its ID.
@@ -74,6 +125,7 @@ class Document:
         """
         return await self.db.find_one({'_id': id})
     
+    @timed
     async def delete_by_id(self, id):
         """
         Delete a document by its ID.
@@ -81,6 +133,7 @@ class Document:
         """
         await self.db.delete_one({'_id': id})
 
+    @timed
     async def insert(self, document):
         """
         Insert a document into the database.
@@ -95,6 +148,7 @@ class Document:
         await self.db.insert_one(document)
 
 
+    @timed
     async def upsert(self, document):
         """
         Update a document in the database.
@@ -111,6 +165,7 @@ class Document:
         
         await self.db.update_one({'_id': document['_id']}, {'$set': document}, upsert=True)
 
+    @timed
     async def update_by_id(self, document):
         """
         Update a document by its _id. Insert if not exists.
@@ -130,6 +185,7 @@ class Document:
             upsert=True
         )
 
+    @timed
     async def unset(self,document):
         """
         To Delete a field in a document.
@@ -142,13 +198,12 @@ class Document:
         if not document["_id"]:
             raise ValueError('document must have an _id field')
         
-        if not await self.find_by_id(document["_id"]):
+        fields = {field: value for field, value in document.items() if field != "_id"}
+        result = await self.db.update_one({'_id': document["_id"]}, {'$unset': fields})
+        if result.matched_count == 0:
             raise ValueError('document does not exist')
-        
-        id = document["_id"]
-        document.pop("_id")
-        await self.db.update({'_id': id}, {'$unset': document})
 
+    @timed
     async def increment(self,id,field,value):
         """
         Increment a field in a document.
@@ -156,19 +211,153 @@ class Document:
         :param field (str): The field to increment.
         :param value (int): The value to increment by.
         """
-
-        if not await self.find_by_id(id):
+        result = await self.db.update_one({'_id': id}, {'$inc': {field: value}})
+        if result.matched_count == 0:
             raise ValueError('document does not exist')
-        
-        await self.db.update_one({'_id': id}, {'$inc': {field: value}})
 
+    @timed
     async def get_all(self):
         """
         Get all documents in the collection.
         :return (list): A list of documents.
         """
-        return await self.db.find({})
+        return await self.db.find({}).to_list(None)
+
+    async def iter(self, query=None, projection=None, batch_size=100):
+        """
+        Stream the documents matching a query, without loading them all at once.
+        :param query (dict): The query to match documents.
+        :param projection (dict): The fields to return, all of them if not given.
+        :param batch_size (int): The number of documents fetched per round trip.
+        :return (async iterator): The documents that match the query.
+        """
+        cursor = self.db.find(query or {}, projection, batch_size=batch_size)
+        # Only the time spent waiting on the cursor is recorded, not the time the caller spends between documents.
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    document = await anext(cursor)
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield document
+        finally:
+            metrics.MONGO_OPERATION_DURATION.observe(elapsed, self.db.name, "iter")
+
+    @timed
+    async def create_index(self, keys, **kwargs):
+        """
+        Create an index on the collection, if it does not exist yet.
+        :param keys (list): The (field, direction) pairs of the index.
+        :param kwargs: The options of the index.
+        :return (str): The name of the index.
+        """
+        return await self.db.create_index(keys, **kwargs)
+
+    @timed
+    async def create_ttl_index(self, field, expire_after, name, **kwargs):
+        """
+        Create a TTL index on the collection, or update its expiry if it exists with another one.
+        :param field (str): The date field documents expire by.
+        :param expire_after (int): The number of seconds after which documents expire.
+        :param name (str): The name of the index.
+        :param kwargs: The other options of the index.
+        :return (str): The name of the index.
+        """
+        try:
+            return await self.db.create_index([(field, 1)], name=name, expireAfterSeconds=expire_after, **kwargs)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+        # The retention setting changed since the index was created.
+        await self.db.database.command("collMod", self.db.name, index={"name": name, "expireAfterSeconds": expire_after})
+        logging.info(f"Updated the expiry of index {name} on {self.db.name} to {expire_after} seconds")
+        return name
     
+    def queue_update(self, id, update, upsert=True):
+        """
+        Queue an update of a document, written later by `flush` in a single bulk write.
+        Updates queued for the same document are merged.
+        :param id (str): The ID of the document.
+        :param update (dict): The update, made of update operators such as `$set` or `$inc`.
+        :param upsert (bool): Whether to insert the document if it does not exist.
+        """
+        queued = self._queued.get(id)
+        if queued is None:
+            self._queued[id] = [{operator: dict(fields) for operator, fields in update.items()}, upsert]
+        else:
+            _merge_update(queued[0], update)
+            queued[1] = queued[1] or upsert
+
+        if self.max_queued and len(self._queued) >= self.max_queued and (
+            self._size_flush is None or self._size_flush.done()
+        ):
+            self._size_flush = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """
+        Write the queued updates in a single unordered bulk write.
+        Updates that could not be written are queued again for the next flush.
+        :return (list): The IDs of the documents written.
+        """
+        async with self._flush_lock:
+            if not self._queued:
+                return []
+            queued, self._queued = self._queued, {}
+            ids = list(queued)
+            requests = [pymongo.UpdateOne({'_id': id}, update, upsert=upsert) for id, (update, upsert) in queued.items()]
+            failed = ids
+            try:
+                with metrics.MONGO_OPERATION_DURATION.time(self.db.name, "bulk_write"):
+                    await self.db.bulk_write(requests, ordered=False)
+                failed = []
+            except pymongo.errors.BulkWriteError as e:
+                failed = [ids[error["index"]] for error in e.details.get("writeErrors", [])]
+                self.logger.warning(f"Failed to write {len(failed)}/{len(ids)} queued updates to {self.db.name}")
+            except pymongo.errors.PyMongoError as e:
+                self.logger.warning(f"Failed to write {len(ids)} queued updates to {self.db.name}: {e}")
+
+            for id in failed:
+                update, upsert = queued[id]
+                newer = self._queued.get(id)
+                if newer is not None:
+                    _merge_update(update, newer[0])
+                    upsert = upsert or newer[1]
+                self._queued[id] = [update, upsert]
+            failed = set(failed)
+            return [id for id in ids if id not in failed]
+
+    def write_behind(self, interval=5.0, max_queued=1000):
+        """
+        Start flushing queued updates periodically.
+        :param interval (float): The number of seconds between two flushes.
+        :param max_queued (int): The number of queued documents that triggers an early flush, 0 to only flush periodically.
+        """
+        self.max_queued = max_queued
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_periodically(interval))
+
+    async def _flush_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                self.logger.exception(f"Failed to flush queued updates to {self.db.name}")
+
+    async def close(self):
+        """
+        Stop the periodic flushes started by `write_behind` and write the queued updates.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    @timed
     async def find_by_query(self, query):
         """
         Find all documents in the collection that match the query.
@@ -177,6 +366,7 @@ class Document:
         """
         return await self.db.find(query).to_list(None)
     
+    @timed
     async def count_all(self, query):
         """
         Count all infractions in the specified guild.
@@ -186,6 +376,7 @@ class Document:
         count = await self.db.count_documents(query)
         return count
 
+    @timed
     async def insert_doc(self, doc):
         """
         Insert a document into the collection.
@@ -194,6 +385,7 @@ class Document:
         result = await self.db.insert_one(doc)
         return result
     
+    @timed
     async def search_id(self, partial_id):
         """
         Search for documents by a partial ID.
@@ -202,6 +394,7 @@ class Document:
         """
         return await self.db.find({"_id": {"$regex": f"^{partial_id}"}}).to_list(None)
 
+    @timed
     async def delete_many(self, query):
         """
         Delete multiple documents in the collection.
@@ -209,10 +402,166 @@ class Document:
         """
         await self.db.delete_many(query)
 
+    @timed
     async def delete_by_query(self, query):
         """
         Delete a document by a query.
         :param query (dict): The query to match the document.
         """
         await self.db.delete_one(query)
-        
\ No newline at end of file
+        
+
+class CachedDocument(Document):
+    def __init__(self, connection, document_name, ttl=300, maxsize=10000):
+        """
+        A Document with a read-through cache of documents by their ID.
+        Writes made through this class invalidate the cached copy, and
+        `watch` keeps the cache coherent with writes made elsewhere.
+        :connection (Mongo Connection): The connection to the MongoDB database.
+        :document_name (str): The name of the document.
+        :ttl (float): The number of seconds a document is cached.
+        :maxsize (int): The maximum number of documents cached.
+        """
+        super().__init__(connection, document_name)
+        self.cache = TTLCache(ttl, maxsize)
+        # document ID -> marker of the read in flight, dropped when the document is invalidated
+        self._reads = {}
+        self._watch_task = None
+
+    async def get(self, id):
+        """
+        Get a document by its ID, from the cache when possible.
+        Missing documents are cached too, so repeated lookups stay cheap.
+        The returned document is shared with the cache and must not be mutated.
+        :param id (str): The ID of the document.
+        :return (dict): The document, or None if it does not exist.
+        """
+        document = self.cache.get(id)
+        if document is MISSING:
+            marker = self._reads[id] = object()
+            try:
+                with metrics.MONGO_OPERATION_DURATION.time(self.db.name, "find_by_id"):
+                    document = await self.db.find_one({'_id': id})
+            finally:
+                # An invalidation during the read means the result may already be stale.
+                fresh = self._reads.get(id) is marker
+                if fresh:
+                    del self._reads[id]
+            if fresh:
+                self.cache.set(id, document)
+        return document
+
+    async def find_by_id(self, id):
+        return await self.get(id)
+
+    async def update(self, query, update):
+        await super().update(query, update)
+        self._invalidate_query(query)
+
+    async def delete_by_id(self, id):
+        await super().delete_by_id(id)
+        self._invalidate(id)
+
+    async def insert(self, document):
+        await super().insert(document)
+        self._invalidate(document['_id'])
+
+    async def insert_one(self, document):
+        await super().insert_one(document)
+        self._invalidate_query(document)
+
+    async def upsert(self, document):
+        await super().upsert(document)
+        self._invalidate(document['_id'])
+
+    async def update_by_id(self, document):
+        await super().update_by_id(document)
+        self._invalidate(document['_id'])
+
+    async def unset(self, document):
+        id = document["_id"]
+        await super().unset(document)
+        self._invalidate(id)
+
+    async def increment(self, id, field, value):
+        await super().increment(id, field, value)
+        self._invalidate(id)
+
+    async def delete_many(self, query):
+        await super().delete_many(query)
+        self._invalidate_query(query)
+
+    async def delete_by_query(self, query):
+        await super().delete_by_query(query)
+        self._invalidate_query(query)
+
+    async def flush(self):
+        ids = await super().flush()
+        for id in ids:
+            self._invalidate(id)
+        return ids
+
+    def _invalidate(self, id):
+        self.cache.invalidate(id)
+        self._reads.pop(id, None)
+
+    def _clear(self):
+        self.cache.clear()
+        self._reads.clear()
+
+    def _invalidate_query(self, query):
+        if '_id' in query and not isinstance(query['_id'], collections.abc.Mapping):
+            self._invalidate(query['_id'])
+        else:
+            self._clear()
+
+    def watch(self):
+        """
+        Start invalidating the cache from a MongoDB change stream.
+        Change streams need a replica set; without one, the cache falls back
+        to its TTL for writes made outside this class. An interrupted stream
+        is reopened with backoff, resuming after the last change seen.
+        """
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        resume_token = None
+        delay = 1.0
+        while True:
+            try:
+                async with self.db.watch(resume_after=resume_token) as stream:
+                    self.logger.info(f"Watching {self.db.name} for changes")
+                    delay = 1.0
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        key = change.get('documentKey', {}).get('_id', MISSING)
+                        if key is MISSING:
+                            # drop, rename and invalidate events carry no document key
+                            self._clear()
+                        else:
+                            self._invalidate(key)
+            except pymongo.errors.OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    self.logger.warning(f"Change streams need a replica set, {self.db.name} relies on TTL: {e}")
+                    self._clear()
+                    return
+                if e.code in CHANGE_STREAM_NOT_RESUMABLE:
+                    resume_token = None
+                self.logger.warning(f"Change stream on {self.db.name} failed, retrying in {delay:.0f} seconds: {e}")
+            except pymongo.errors.PyMongoError as e:
+                self.logger.warning(f"Change stream on {self.db.name} interrupted, retrying in {delay:.0f} seconds: {e}")
+
+            if resume_token is None:
+                # Changes made while the stream was down cannot be replayed.
+                self._clear()
+            await asyncio.sleep(delay)
+            delay = min(60.0, delay * 2)
+
+    def stop_watching(self):
+        """
+        Stop the change stream started by `watch`.
+        """
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
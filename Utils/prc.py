@@ -1,14 +1,27 @@
 import asyncio
+import dataclasses
 from discord.ext import commands
 import aiohttp
-import pymongo
-import os
+import json
+import logging
+import random
+import time
+from decouple import config
 from dotenv import load_dotenv
 
+from Utils.cache import TTLCache, MISSING
+from Utils.ratelimit import RateLimiter
+from Utils import metrics
+
+try:
+    # orjson decodes large player lists noticeably faster, but is optional
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 load_dotenv()
 
-mongo = pymongo.MongoClient(os.getenv("MONGO_URI"))
-db = mongo["erlc_checker"]
 class ServerLinkNotFound(commands.CheckFailure):
     pass
 
@@ -18,13 +31,61 @@ class ResponseFailed(Exception):
     data: str
 
     def __init__(self, data: str, detail: str | None = None, code: int | None = None, *args, **kwargs):
+        super().__init__(detail or data)
+        self.data = data
+        self.detail = detail
+        self.code = code
         for k, v in kwargs.items():
             setattr(self, k, v)
 
     def __repr__(self) -> str:
         return f"ResponseFailed(data={self.data}, detail={self.detail}, code={self.code})"
 
-class ServerStatus():
+def _split_player(value: str | None) -> tuple[str | None, int | None]:
+    """Split a PRC `Name:UserId` string into its name and Roblox user ID."""
+    if not value:
+        return None, None
+    name, _, user_id = value.rpartition(":")
+    if not name:
+        return user_id, None
+    try:
+        return name, int(user_id)
+    except ValueError:
+        return value, None
+
+
+class Model:
+    """
+    Base class of the PRC response models.
+    Models are slotted dataclasses whose fields are named after the keys of
+    the API response, and are decoded positionally in a single pass.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def _api_fields(cls):
+        keys = cls.__dict__.get("_keys")
+        if keys is None:
+            keys = tuple(
+                (f.name, None if f.default is dataclasses.MISSING else f.default)
+                for f in dataclasses.fields(cls) if f.init
+            )
+            cls._keys = keys
+        return keys
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        get = data.get
+        return cls(*[get(key, default) for key, default in cls._api_fields()])
+
+    @classmethod
+    def from_list(cls, data: list[dict]):
+        keys = cls._api_fields()
+        return [cls(*[x.get(key, default) for key, default in keys]) for x in data]
+
+
+@dataclasses.dataclass(slots=True)
+class ServerStatus(Model):
     Name: str | None = None
     OwnerId: int | None = None
     CoOwnerIds: list[int] | None = None
@@ -34,131 +95,244 @@ class ServerStatus():
     AccVerifiedReq: str = ""
     TeamBalance: bool = False
 
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-class ServerPlayers():
-    Player: str | None
-    Permission: str
-    Callsign: str | None
-    Team: str | None
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerJoinLogs():
-    Join: bool
-    Timestamp: int
-    Player: str | None
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerQueue():
-    total_players: int
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerKillLogs():
-    killed: str | None
-    timestamp: int
-    killer: str | None
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerCommandLogs():
-    player: str | None
-    timestamp: int
-    command: str | None
-
-
-class ServerModCalls():
-    caller: str | None
-    moderator: str | None
-    timestamp: int
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerBans():
-    player_id: int
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerVehicles():
-    texture: str | None
-    name: str | None
-    owner: str | None
-
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-
-class ServerCommand():
-    command: str | None
+@dataclasses.dataclass(slots=True)
+class ServerPlayers(Model):
+    Player: str | None = None
+    Permission: str | None = None
+    Callsign: str | None = None
+    Team: str | None = None
+    name: str | None = dataclasses.field(init=False, default=None)
+    user_id: int | None = dataclasses.field(init=False, default=None)
+
+    def __post_init__(self):
+        self.name, self.user_id = _split_player(self.Player)
+
+@dataclasses.dataclass(slots=True)
+class ServerJoinLogs(Model):
+    Join: bool = False
+    Timestamp: int = 0
+    Player: str | None = None
+    name: str | None = dataclasses.field(init=False, default=None)
+    user_id: int | None = dataclasses.field(init=False, default=None)
+
+    def __post_init__(self):
+        self.name, self.user_id = _split_player(self.Player)
+
+@dataclasses.dataclass(slots=True)
+class ServerQueue(Model):
+    players: list[int] = dataclasses.field(default_factory=list)
+
+    @property
+    def total_players(self) -> int:
+        return len(self.players)
+
+@dataclasses.dataclass(slots=True)
+class ServerKillLogs(Model):
+    Killed: str | None = None
+    Timestamp: int = 0
+    Killer: str | None = None
+
+@dataclasses.dataclass(slots=True)
+class ServerCommandLogs(Model):
+    Player: str | None = None
+    Timestamp: int = 0
+    Command: str | None = None
+
+@dataclasses.dataclass(slots=True)
+class ServerModCalls(Model):
+    Caller: str | None = None
+    Moderator: str | None = None
+    Timestamp: int = 0
+
+@dataclasses.dataclass(slots=True)
+class ServerBans(Model):
+    player_id: int = 0
+    name: str | None = None
+
+@dataclasses.dataclass(slots=True)
+class ServerVehicles(Model):
+    Texture: str | None = None
+    Name: str | None = None
+    Owner: str | None = None
 
-    def __init__(self, *args, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+@dataclasses.dataclass(slots=True)
+class ServerCommand(Model):
+    command: str | None = None
 
 class PRC_API_Client:
     def __init__(self, bot, base_url: str, api_key: str):
         self.bot = bot
         self.base_url = base_url
         self.api_key = api_key
-        self.session = aiohttp.ClientSession()
+        # Created by start() inside the running event loop
+        self.session = None
+        self.connector = None
+        self.max_retries = config('PRC_MAX_RETRIES', default=3, cast=int)
+        self.ratelimiter = RateLimiter(
+            rate=config('PRC_RATE', default=1.0, cast=float),
+            capacity=config('PRC_BURST', default=5, cast=int),
+            global_rate=config('PRC_GLOBAL_RATE', default=35.0, cast=float),
+            global_capacity=config('PRC_GLOBAL_BURST', default=35, cast=int)
+        )
+        # GET responses per (server key, endpoint), shared by every caller for a few seconds
+        self.responses = TTLCache(
+            ttl=config('PRC_RESPONSE_TTL', default=5.0, cast=float),
+            maxsize=config('PRC_RESPONSE_CACHE_SIZE', default=10000, cast=int)
+        )
+        # (server key, endpoint) -> task of the GET request in flight
+        self._inflight = {}
+        # server ID -> _id of its settings document, for the older documents not keyed by the server ID
+        self._settings_ids = {}
+
+    async def start(self):
+        """
+        Open the HTTP session. Connections are kept alive and shared by every
+        guild check, so a check rarely pays for a new TCP and TLS handshake.
+        """
+        if self.session is not None and not self.session.closed:
+            return
+        self.connector = aiohttp.TCPConnector(
+            limit=config('PRC_POOL_SIZE', default=100, cast=int),
+            limit_per_host=config('PRC_POOL_PER_HOST', default=50, cast=int),
+            ttl_dns_cache=config('PRC_DNS_CACHE_TTL', default=300, cast=int),
+            keepalive_timeout=config('PRC_KEEPALIVE_TIMEOUT', default=30.0, cast=float),
+            enable_cleanup_closed=True
+        )
+        self.session = aiohttp.ClientSession(
+            connector=self.connector,
+            timeout=aiohttp.ClientTimeout(
+                total=config('PRC_TIMEOUT', default=15.0, cast=float),
+                connect=config('PRC_CONNECT_TIMEOUT', default=5.0, cast=float)
+            )
+        )
 
     async def close(self):
-        await self.session.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.connector = None
+
+    def pool_stats(self):
+        """
+        Get the utilization of the connection pool.
+        :return (dict): The number of connections in use and idle, and the pool limits.
+        """
+        connector = self.connector
+        if connector is None or connector.closed:
+            return {"in_use": 0, "idle": 0, "limit": 0, "limit_per_host": 0}
+        # aiohttp does not expose these counts publicly
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        return {
+            "in_use": len(getattr(connector, "_acquired", ())),
+            "idle": idle,
+            "limit": connector.limit,
+            "limit_per_host": connector.limit_per_host
+        }
 
     async def fetch_server_key(self, server_id: int):
-        server_key = await self.bot.settings.db.find_one({"guild_id": str(server_id)})
+        server_key = await self.bot.settings.get(self._settings_ids.get(server_id, server_id))
+        if not server_key:
+            # Older documents are keyed by a string guild_id field. Their _id is remembered,
+            # so later reads go through the settings cache instead of querying the collection.
+            self._settings_ids.pop(server_id, None)
+            legacy = await self.bot.settings.db.find_one({"guild_id": str(server_id)}, {"_id": 1})
+            if legacy:
+                self._settings_ids[server_id] = legacy["_id"]
+                server_key = await self.bot.settings.get(legacy["_id"])
 
         if not server_key:
-            print(f"Server key not found for {server_id}")
+            logging.warning(f"Server key not found for {server_id}")
             return None
-        
-        print(f"Fetching server key for {server_id}: {"Found" if server_key else "Not Found"}")
+
         return server_key
 
+    @staticmethod
+    def _retry_after(resp, data, attempt: int) -> float:
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after is None and isinstance(data, dict):
+            retry_after = data.get("retry_after")
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            # Exponential backoff with jitter when the API does not say how long to wait
+            return min(30.0, 2 ** attempt) + random.random()
+
     async def _send_request(self, method: str, endpoint: str, server_id: int, **kwargs):
         server_key = await self.fetch_server_key(server_id)
         if not server_key or "api_key" not in server_key:
-            print(f"Skipping {server_id} due to missing server key")
-        async with self.session.request(method, f"{self.base_url}/{endpoint}", headers={
-            "Server-Key": server_key['api_key'],
-            "Content-Type":"application/json"
-            }, **kwargs) as resp:
-            data = await resp.json()
+            raise ServerLinkNotFound(f"Server {server_id} is not linked")
+
+        key = server_key['api_key']
+        if method != "GET":
+            return await self._request(method, endpoint, server_id, key, **kwargs)
+
+        cache_key = (key, endpoint)
+        data = self.responses.get(cache_key)
+        if data is not MISSING:
+            return data
+
+        # Concurrent callers share a single request instead of each sending their own
+        task = self._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._request(method, endpoint, server_id, key, **kwargs))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda done: self._request_done(cache_key, done))
+        # A cancelled caller must not cancel the request for the others
+        return await asyncio.shield(task)
+
+    def _request_done(self, cache_key, task):
+        self._inflight.pop(cache_key, None)
+        if task.cancelled():
+            return
+        # Retrieving the exception also keeps it from being logged as never retrieved
+        if task.exception() is None:
+            self.responses.set(cache_key, task.result())
+
+    async def _request(self, method: str, endpoint: str, server_id: int, key: str, **kwargs):
+        data = None
+        for attempt in range(self.max_retries + 1):
+            await self.ratelimiter.acquire(key)
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, f"{self.base_url}/{endpoint}", headers={
+                    "Server-Key": key,
+                    "Content-Type":"application/json"
+                    }, **kwargs) as resp:
+                    self.ratelimiter.update(key, resp.headers)
+                    data = await resp.json(loads=json_loads, content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.PRC_REQUEST_DURATION.observe(time.perf_counter() - start, endpoint, "error")
+                if attempt < self.max_retries:
+                    logging.warning(f"Request to {endpoint} failed for {server_id} ({e!r}), retrying")
+                    await asyncio.sleep(min(30.0, 2 ** attempt) + random.random())
+                    continue
+                raise ResponseFailed(data, detail=f"Request to {endpoint} failed: {e!r}") from e
+
+            metrics.PRC_REQUEST_DURATION.observe(time.perf_counter() - start, endpoint, resp.status)
             if resp.status == 200:
                 return data
-            elif resp.status == 429:
-                print(f"Rate limited on {server_id}")
-                return data
+
+            detail = (data.get("message") or data.get("detail")) if isinstance(data, dict) else None
+            if resp.status == 429:
+                retry_after = self._retry_after(resp, data, attempt)
+                logging.warning(f"Rate limited on {server_id}, retrying in {retry_after:.2f} seconds")
+                self.ratelimiter.block(key, retry_after)
+                continue
+            elif resp.status == 500 and attempt < self.max_retries:
+                logging.warning(f"Problem communicating with Roblox for {server_id}, retrying")
+                await asyncio.sleep(min(30.0, 2 ** attempt) + random.random())
+                continue
             elif resp.status == 400:
-                print(f"Bad request on {server_id}")
-                return data
+                logging.warning(f"Bad request on {server_id}")
             elif resp.status == 403:
-                print(f"Unauthorized on {server_id}")
-                return data
+                logging.warning(f"Unauthorized on {server_id}")
             elif resp.status == 422:
-                print("The private server has no players in it")
-                return data
-            elif resp.status == 500:
-                print("Problem communicating with Roblox")
-                return data
+                logging.info(f"The private server of {server_id} has no players in it")
             else:
-                print(f"{data.get("detail")}")
-                return data
+                logging.warning(f"Request to {endpoint} failed for {server_id}: {detail}")
+            raise ResponseFailed(data, detail=detail, code=resp.status)
+
+        raise ResponseFailed(data, detail="Rate limited", code=429)
             
     async def _send_test_request(self, api_key: str):
         async with self.session.request("GET", f"{self.base_url}/server", headers={"Server-Key": api_key}) as resp:
@@ -167,31 +341,40 @@ class PRC_API_Client:
             return False
 
     async def _fetch_server_status(self, server_id: int):
-        return ServerStatus(**await self._send_request("GET", "server", server_id))
+        return ServerStatus.from_dict(await self._send_request("GET", "server", server_id))
 
     async def _fetch_server_players(self, server_id: int):
-        return [ServerPlayers(**x) for x in await self._send_request("GET", "server/players", server_id)]
+        try:
+            data = await self._send_request("GET", "server/players", server_id)
+        except ResponseFailed as e:
+            if e.code == 422:
+                # The private server has no players in it
+                return []
+            raise
+        return ServerPlayers.from_list(data)
 
     async def _fetch_server_join_logs(self, server_id: int):
-        return [ServerJoinLogs(**x) for x in await self._send_request("GET", "server/joinlogs", server_id)]
+        return ServerJoinLogs.from_list(await self._send_request("GET", "server/joinlogs", server_id))
 
     async def _fetch_server_queue(self, server_id: int):
-        return ServerQueue(**await self._send_request("GET", "server/queue", server_id))
+        return ServerQueue(await self._send_request("GET", "server/queue", server_id))
     
     async def _fetch_server_killlogs(self, server_id: int):
-        return [ServerKillLogs(**x) for x in await self._send_request("GET", "server/killlogs", server_id)]
+        return ServerKillLogs.from_list(await self._send_request("GET", "server/killlogs", server_id))
 
     async def _fetch_server_commandlogs(self, server_id: int):
-        return ServerCommandLogs(**await self._send_request("GET", "server/commandlogs", server_id))
+        return ServerCommandLogs.from_list(await self._send_request("GET", "server/commandlogs", server_id))
 
     async def _fetch_server_modcalls(self, server_id: int):
-        return [ServerModCalls(**x) for x in await self._send_request("GET", "server/modcalls", server_id)]
+        return ServerModCalls.from_list(await self._send_request("GET", "server/modcalls", server_id))
 
     async def _fetch_server_bans(self, server_id: int):
-        return [ServerBans(**x) for x in await self._send_request("GET", "server/bans", server_id)]
+        # Bans are returned as a mapping of player ID to player name
+        data = await self._send_request("GET", "server/bans", server_id)
+        return [ServerBans(int(player_id), name) for player_id, name in data.items()]
 
     async def _fetch_server_vehicles(self, server_id: int):
-        return [ServerVehicles(**x) for x in await self._send_request("GET", "server/vehicles", server_id)]
+        return ServerVehicles.from_list(await self._send_request("GET", "server/vehicles", server_id))
     
     async def _send_command(self, server_id: int, command: str):
         return await self._send_request("POST", "server/command", server_id, json={"command": command})
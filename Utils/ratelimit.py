@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+
+"""
+This module contains the token buckets used to keep PRC API traffic under
+its rate limits. A RateLimiter holds one bucket per server key plus a global
+bucket shared by every key, and learns from the `X-RateLimit-*` and
+`Retry-After` headers sent back by the API.
+"""
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        """
+        A class to represent a token bucket.
+        Waiters are served in order, so bursts are queued instead of failing.
+        :param rate (float): The number of tokens added per second.
+        :param capacity (int): The maximum number of tokens held.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        """
+        Stop handing out tokens for a number of seconds.
+        :param seconds (float): The number of seconds to block for.
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    @property
+    def idle(self):
+        """
+        Whether the bucket is full and nobody is waiting on it.
+        """
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+
+class RateLimiter:
+    def __init__(self, rate, capacity, global_rate, global_capacity, max_buckets=5000):
+        """
+        A class to rate limit requests per key and globally.
+        :param rate (float): The number of requests per second allowed per key.
+        :param capacity (int): The burst size allowed per key.
+        :param global_rate (float): The number of requests per second allowed across all keys.
+        :param global_capacity (int): The burst size allowed across all keys.
+        :param max_buckets (int): The number of per-key buckets kept before idle ones are dropped.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.max_buckets = max_buckets
+        self.global_bucket = TokenBucket(global_rate, global_capacity)
+        self.buckets = {}
+
+    def bucket(self, key):
+        """
+        Get the bucket of a key, creating it if needed.
+        :param key (str): The key.
+        :return (TokenBucket): The bucket of the key.
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.buckets = {k: b for k, b in self.buckets.items() if not b.idle}
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+    async def acquire(self, key):
+        """
+        Wait until a request for a key is allowed.
+        :param key (str): The key.
+        """
+        await self.bucket(key).acquire()
+        await self.global_bucket.acquire()
+
+    def block(self, key, seconds):
+        """
+        Block requests for a key for a number of seconds.
+        :param key (str): The key.
+        :param seconds (float): The number of seconds to block for.
+        """
+        self.bucket(key).block(seconds)
+
+    def update(self, key, headers):
+        """
+        Update the bucket of a key from rate limit response headers.
+        :param key (str): The key.
+        :param headers (Mapping): The response headers.
+        """
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+
+        if remaining <= 0:
+            # X-RateLimit-Reset is a unix timestamp
+            self.block(key, max(0.0, reset - time.time()))
@@ -0,0 +1,165 @@
+import time
+
+from Utils.member_index import normalize_name
+
+
+"""
+This module contains the RosterTracker class, which remembers the last
+player roster seen on each guild's private server. Only players who joined
+since the previous check are matched against the member index, unless the
+guild's members changed in between, in which case everyone is re-checked.
+"""
+
+class RosterSnapshot:
+    __slots__ = ("players", "missing", "version", "threshold", "joined", "checked_at")
+
+    def __init__(self, players, missing, version, threshold, joined=0):
+        """
+        A class to represent the roster of a server at its last check.
+        :param players (dict): Roblox user ID -> player name.
+        :param missing (set): The Roblox user IDs of the players not in the Discord server.
+        :param version (int): The version of the member index used for the check.
+        :param threshold (int): The fuzzy matching threshold used for the check.
+        :param joined (int): The number of players who joined since the previous check.
+        """
+        self.players = players
+        self.missing = missing
+        self.version = version
+        self.threshold = threshold
+        self.joined = joined
+        self.checked_at = time.monotonic()
+
+
+class RosterDiff:
+    __slots__ = ("missing", "joined", "left", "checked")
+
+    def __init__(self, missing, joined, left, checked):
+        """
+        A class to represent the result of a roster check.
+        :param missing (dict): Roblox user ID -> name of the players not in the Discord server.
+        :param joined (int): The number of players who joined since the last check.
+        :param left (int): The number of players who left since the last check.
+        :param checked (int): The number of players matched against the member index.
+        """
+        self.missing = missing
+        self.joined = joined
+        self.left = left
+        self.checked = checked
+
+
+class RosterTracker:
+    def __init__(self, index, links=None):
+        """
+        A class to track the rosters of every guild's private server.
+        :param index (MemberNameIndex): The member name index to match players against.
+        :param links (LinkStore): The Roblox to Discord links to resolve players by ID first, if any.
+        """
+        self.index = index
+        self.links = links
+        self._snapshots = {}
+
+    def resolve(self, guild_id, user_id, name):
+        """
+        Check if a player is in the Discord server of a guild, without fuzzy matching.
+        Players are resolved by their linked Discord account first, then by name.
+        An exact name match on a single member is recorded as a link.
+        :param guild_id (int): The ID of the guild.
+        :param user_id (int): The Roblox user ID of the player.
+        :param name (str): The normalized name of the player.
+        :return (bool): Whether the player is in the Discord server.
+        """
+        if self.links is not None:
+            discord_id = self.links.get(guild_id, user_id)
+            if discord_id is not None and self.index.has_member(guild_id, discord_id):
+                return True
+
+        member_ids = self.index.lookup(guild_id, name)
+        if member_ids:
+            if self.links is not None and len(member_ids) == 1:
+                self.links.confirm(guild_id, user_id, next(iter(member_ids)))
+            return True
+        return False
+
+    async def find_missing(self, guild_id, players, threshold=0):
+        """
+        Find the players who are not in the Discord server of a guild.
+        Players not resolved by link or exact name are fuzzy matched all at once.
+        :param guild_id (int): The ID of the guild.
+        :param players (dict): Roblox user ID -> name of the players.
+        :param threshold (int): The fuzzy matching threshold of the guild, 0 for exact matching only.
+        :return (dict): Roblox user ID -> name of the players not in the Discord server.
+        """
+        unresolved = {}
+        for user_id, name in players.items():
+            normalized = normalize_name(name)
+            if not self.resolve(guild_id, user_id, normalized):
+                unresolved[user_id] = normalized
+
+        if threshold > 0 and unresolved:
+            matched = await self.index.matches(guild_id, set(unresolved.values()), threshold)
+            return {user_id: players[user_id] for user_id, name in unresolved.items() if name not in matched}
+        return {user_id: players[user_id] for user_id in unresolved}
+
+    async def check(self, guild_id, players, threshold=0):
+        """
+        Find the players of a server who are not in its Discord server.
+        :param guild_id (int): The ID of the guild.
+        :param players (list[ServerPlayers]): The players currently in the server.
+        :param threshold (int): The fuzzy matching threshold of the guild, 0 for exact matching only.
+        :return (RosterDiff): The players not in the Discord server and the roster changes.
+        """
+        snapshot = self._snapshots.get(guild_id)
+        previous = snapshot.players if snapshot else {}
+        version = self.index.version(guild_id)
+
+        # Names are kept as shown in-game, for warnings and alerts, and only normalized to be matched.
+        current = {player.user_id: player.name for player in players if player.user_id is not None}
+
+        if snapshot is None or snapshot.version != version or snapshot.threshold != threshold:
+            # Members joined, left or were renamed: every player has to be re-checked.
+            to_check = current.keys()
+            missing = set()
+        else:
+            to_check = current.keys() - previous.keys()
+            missing = snapshot.missing & current.keys()
+
+        missing.update(await self.find_missing(guild_id, {user_id: current[user_id] for user_id in to_check}, threshold))
+
+        joined = len(current.keys() - previous.keys())
+        self._snapshots[guild_id] = RosterSnapshot(current, missing, version, threshold, joined)
+
+        return RosterDiff(
+            missing={user_id: name for user_id, name in current.items() if user_id in missing},
+            joined=joined,
+            left=len(previous.keys() - current.keys()),
+            checked=len(to_check)
+        )
+
+    def player_count(self, guild_id):
+        """
+        Get the number of players in a server at its last check.
+        :param guild_id (int): The ID of the guild.
+        :return (int): The number of players, 0 if the server was never checked.
+        """
+        snapshot = self._snapshots.get(guild_id)
+        return len(snapshot.players) if snapshot else 0
+
+    def activity(self, guild_id):
+        """
+        Get the activity seen on a server at its last check.
+        :param guild_id (int): The ID of the guild.
+        :return (tuple): The number of players, the number of players who joined
+            since the check before, and the monotonic time of the check; all None
+            if the server was never checked.
+        """
+        snapshot = self._snapshots.get(guild_id)
+        if snapshot is None:
+            return None, None, None
+        return len(snapshot.players), snapshot.joined, snapshot.checked_at
+
+    def forget(self, guild_id):
+        """
+        Drop the roster of a guild.
+        :param guild_id (int): The ID of the guild.
+        """
+        self._snapshots.pop(guild_id, None)
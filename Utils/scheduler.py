@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import time
+
+
+"""
+This module contains helpers to fan work out concurrently: fan_out to
+process items with a concurrency limit, and a GuildScheduler to decide
+when each guild is checked next. PRC calls are rate limited by the PRC
+client itself, per server key and globally.
+"""
+
+async def fan_out(items, func, limit):
+    """
+    Call an async function on every item of an async iterable, with at most
+    `limit` calls running at once. Items are only pulled from the iterable
+    when a slot is free.
+    :param items (async iterable): The items to process.
+    :param func (coroutine function): The function to call with each item.
+    :param limit (int): The maximum number of calls running at once.
+    :return (list): The results of the calls.
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+    tasks = []
+
+    async def _run(item):
+        try:
+            return await func(item)
+        finally:
+            semaphore.release()
+
+    async for item in items:
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(_run(item)))
+
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class GuildScheduler:
+    def __init__(self, base_interval, min_interval, max_interval, budget):
+        """
+        A class to schedule guild checks by their next due time.
+        Idle servers are checked less and less often, busy ones more often,
+        and no more than `budget` checks are started per minute.
+        :param base_interval (float): The number of seconds between checks of a normally active server.
+        :param min_interval (float): The minimum number of seconds between two checks of a server.
+        :param max_interval (float): The maximum number of seconds between two checks of a server.
+        :param budget (int): The maximum number of checks started per minute.
+        """
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self._tokens = float(budget)
+        self._refilled_at = time.monotonic()
+        # (due at, guild ID) entries; entries not matching _due are stale
+        self._heap = []
+        # guild ID -> due at, for guilds waiting in the queue
+        self._due = {}
+        # guild ID -> current interval
+        self._intervals = {}
+        # guild ID -> key of the settings document
+        self.keys = {}
+        self.running = set()
+        # IDs of the linked guilds the bot is no longer in, checked at the maximum interval
+        self.departed = set()
+
+    def __len__(self):
+        return len(self._due)
+
+    def sync(self, keys):
+        """
+        Replace the scheduled guilds, keeping the schedule of known ones.
+        New guilds are due immediately.
+        :param keys (dict): Guild ID -> key of the settings document.
+        """
+        now = time.monotonic()
+        for guild_id in keys.keys() - self.keys.keys():
+            self.schedule(guild_id, now)
+        for guild_id in self.keys.keys() - keys.keys():
+            self._due.pop(guild_id, None)
+            self._intervals.pop(guild_id, None)
+            self.departed.discard(guild_id)
+        self.keys = keys
+
+    def schedule(self, guild_id, due_at):
+        """
+        Schedule the next check of a guild.
+        :param guild_id (int): The ID of the guild.
+        :param due_at (float): The monotonic time the check is due at.
+        """
+        self._due[guild_id] = due_at
+        heapq.heappush(self._heap, (due_at, guild_id))
+
+    def _refill(self, now):
+        self._tokens = min(float(self.budget), self._tokens + (now - self._refilled_at) * self.budget / 60)
+        self._refilled_at = now
+
+    def pop_due(self):
+        """
+        Take the guilds whose check is due, within the request budget.
+        Guilds over budget stay queued and are returned by a later call.
+        :return (list[tuple]): (guild ID, seconds overdue) of each guild to check.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        due = []
+        while self._heap and self._heap[0][0] <= now and self._tokens >= 1:
+            due_at, guild_id = heapq.heappop(self._heap)
+            if self._due.get(guild_id) != due_at:
+                continue
+            del self._due[guild_id]
+            self._tokens -= 1
+            self.running.add(guild_id)
+            due.append((guild_id, now - due_at))
+        return due
+
+    def spend(self, count):
+        """
+        Take up to `count` requests from the budget shared with the checks,
+        for work done outside of the schedule.
+        :param count (int): The number of requests wanted.
+        :return (int): The number of requests granted.
+        """
+        self._refill(time.monotonic())
+        granted = max(0, min(count, int(self._tokens)))
+        self._tokens -= granted
+        return granted
+
+    @property
+    def backlog(self):
+        """
+        The number of guilds whose check is overdue.
+        """
+        now = time.monotonic()
+        return sum(1 for due_at in self._due.values() if due_at <= now)
+
+    def done(self, guild_id, players, joined, minimum_players=0):
+        """
+        Reschedule a guild after its check, from the activity seen on its server.
+        :param guild_id (int): The ID of the guild.
+        :param players (int): The number of players in the server, None if the check failed.
+        :param joined (int): The number of players who joined since the previous check.
+        :param minimum_players (int): The number of players below which the guild is not checked.
+        """
+        self.running.discard(guild_id)
+        if guild_id not in self.keys:
+            return
+
+        interval = self._intervals.get(guild_id, self.base_interval)
+        if guild_id in self.departed:
+            # Each check of a guild the bot left costs a REST call to find out it is still gone.
+            interval = self.max_interval
+        elif players is None:
+            interval = self.base_interval
+        elif players == 0 or players < minimum_players:
+            # Nobody to check: back off exponentially.
+            interval = min(self.max_interval, max(interval, self.base_interval) * 2)
+        elif joined:
+            # Players are joining: check sooner, the more joins the sooner.
+            interval = max(self.min_interval, self.base_interval / (1 + joined / 2))
+        else:
+            interval = self.base_interval
+
+        self._intervals[guild_id] = interval
+        self.schedule(guild_id, time.monotonic() + interval)
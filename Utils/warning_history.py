@@ -0,0 +1,146 @@
+import datetime
+import logging
+import time
+
+import pytz
+
+from Utils.cache import TTLCache
+
+
+"""
+This module contains the WarningHistory class, which remembers, for every
+player seen missing from a Discord server, when they were first seen, when
+they were last warned in-game and how many times. Records are kept in memory
+for O(1) lookups and written behind to a MongoDB collection, where a TTL
+index expires them after the same retention period as in memory.
+"""
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        # MongoDB returns naive datetimes in UTC
+        value = value.replace(tzinfo=pytz.utc)
+    return value.timestamp()
+
+
+def _datetime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, pytz.utc)
+
+
+class WarningRecord:
+    __slots__ = ("first_seen", "last_warned", "count")
+
+    def __init__(self, first_seen, last_warned=None, count=0):
+        self.first_seen = first_seen
+        self.last_warned = last_warned
+        self.count = count
+
+
+class WarningHistory:
+    def __init__(self, document, cooldown=300, escalate_after=3, retention=7 * 86400, maxsize=200000):
+        """
+        A class to represent the warning history of players per guild.
+        :param document (Document): The collection records are written to.
+        :param cooldown (float): The number of seconds during which a player is not warned again.
+        :param escalate_after (int): The number of warnings after which a player gets the escalation message, 0 to never escalate.
+        :param retention (float): The number of seconds a record is kept after its last update.
+        :param maxsize (int): The maximum number of records kept in memory.
+        """
+        self.document = document
+        self.cooldown = cooldown
+        self.escalate_after = escalate_after
+        self.retention = retention
+        # (guild_id, roblox ID) -> WarningRecord
+        self.records = TTLCache(retention, maxsize)
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def _id(guild_id, roblox_id):
+        return f"{guild_id}:{roblox_id}"
+
+    async def load(self, query=None):
+        """
+        Load the records from the database.
+        :param query (dict): The query to match the records to load, all of them if not given.
+        """
+        async for record in self.document.iter(query, {"guild_id": 1, "roblox_id": 1, "first_seen": 1, "last_warned": 1, "count": 1}):
+            self.records.set((record["guild_id"], record["roblox_id"]), WarningRecord(
+                _timestamp(record.get("first_seen")) or time.time(),
+                _timestamp(record.get("last_warned")),
+                record.get("count", 0)
+            ))
+        self.logger.info(f"Loaded {len(self.records)} warning records")
+
+    def get(self, guild_id, roblox_id):
+        """
+        Get the record of a player.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID of the player.
+        :return (WarningRecord): The record, or None if the player has no record.
+        """
+        return self.records.get((guild_id, roblox_id), None)
+
+    def seen(self, guild_id, roblox_id):
+        """
+        Record a player seen missing from the Discord server.
+        Only the first sighting is written.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID of the player.
+        :return (WarningRecord): The record of the player.
+        """
+        record = self.get(guild_id, roblox_id)
+        if record is not None:
+            return record
+
+        now = time.time()
+        record = WarningRecord(now)
+        self.records.set((guild_id, roblox_id), record)
+        self.document.queue_update(self._id(guild_id, roblox_id), {
+            "$set": {"guild_id": guild_id, "roblox_id": roblox_id, "updated_at": _datetime(now)},
+            "$setOnInsert": {"first_seen": _datetime(now)}
+        })
+        return record
+
+    def due(self, guild_id, roblox_id):
+        """
+        Check if a player can be warned, that is, was not warned within the cooldown.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID of the player.
+        :return (bool): Whether the player can be warned.
+        """
+        record = self.get(guild_id, roblox_id)
+        return record is None or record.last_warned is None or time.time() - record.last_warned >= self.cooldown
+
+    def escalated(self, guild_id, roblox_id):
+        """
+        Check if a player was warned enough times to get the escalation message.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID of the player.
+        :return (bool): Whether the warnings of the player are escalated.
+        """
+        record = self.get(guild_id, roblox_id)
+        return self.escalate_after > 0 and record is not None and record.count >= self.escalate_after
+
+    def warned(self, guild_id, roblox_id):
+        """
+        Record a warning sent to a player.
+        :param guild_id (int): The ID of the guild.
+        :param roblox_id (int): The Roblox user ID of the player.
+        """
+        now = time.time()
+        record = self.get(guild_id, roblox_id) or WarningRecord(now)
+        record.last_warned = now
+        record.count += 1
+        # Setting the record again restarts its retention, like the TTL index does.
+        self.records.set((guild_id, roblox_id), record)
+        self.document.queue_update(self._id(guild_id, roblox_id), {
+            "$set": {
+                "guild_id": guild_id,
+                "roblox_id": roblox_id,
+                "last_warned": _datetime(now),
+                "updated_at": _datetime(now)
+            },
+            "$setOnInsert": {"first_seen": _datetime(record.first_seen)},
+            "$inc": {"count": 1}
+        })
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+
+from Tasks import discord_check
+from Utils.dispatcher import CommandDispatcher
+from Utils.warning_history import WarningHistory
+from Utils.links import LinkStore
+from Utils.member_index import MemberNameIndex
+from Utils.prc import PRC_API_Client
+from Utils.roster import RosterTracker
+from Utils.scheduler import GuildScheduler
+from benchmarks.fakes import FakePRCServer, MemorySettings, make_guild
+
+
+"""
+Benchmark of the Discord check pipeline.
+
+Generates synthetic guilds, serves their rosters from a local stand-in for
+the PRC API and runs the checker against them, reporting per-guild and
+per-iteration latency, throughput and memory. Latency is measured without
+allocation tracing, which slows Python down several times; memory is traced
+in a separate cold pass, on a bot of its own.
+
+    python -m benchmarks.check_pipeline --guilds 300 --members 40000 --players 40
+"""
+
+class BenchBot:
+    def __init__(self, guilds, settings, executor=None, pool_threshold=20000, lean=False):
+        """
+        A class with the parts of the Bot used by the checker.
+        :param guilds (dict): Guild ID -> FakeGuild.
+        :param settings (MemorySettings): The settings store.
+        :param executor (Executor): The process pool large guilds are indexed in.
+        :param pool_threshold (int): The member count from which guilds are indexed in the pool.
+        :param lean (bool): Whether the member index fetches members itself, as in lean mode.
+        """
+        self.guilds = guilds
+        self.settings = settings
+        self.member_index = MemberNameIndex(executor=executor, threshold=pool_threshold, lean=lean)
+        self.links = LinkStore(MemorySettings([]))
+        self.rosters = RosterTracker(self.member_index, self.links)
+        self.warnings = WarningHistory(MemorySettings([]))
+        self.check_stats = MemorySettings([])
+        self.cache_ready = asyncio.Event()
+        self.cache_ready.set()
+        self.prc_api = None
+        self.dispatcher = None
+        self.alerts = None
+
+    def settings_query(self, query=None):
+        return dict(query or {})
+
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    async def fetch_guild(self, guild_id):
+        return self.guilds[guild_id]
+
+    async def chunk_guild(self, guild):
+        await self.member_index.ensure(guild)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the Discord check pipeline.")
+    parser.add_argument("--guilds", type=int, default=50, help="Number of linked guilds.")
+    parser.add_argument("--members", type=int, default=5000, help="Members per guild.")
+    parser.add_argument("--players", type=int, default=40, help="Players per private server.")
+    parser.add_argument("--missing", type=float, default=0.2, help="Share of players not in the Discord server.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency added by the fake PRC API.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of PRC requests answered with a 429.")
+    parser.add_argument("--iterations", type=int, default=3, help="Number of check iterations.")
+    parser.add_argument("--concurrency", type=int, default=discord_check.CHECK_CONCURRENCY, help="Guilds checked at once.")
+    parser.add_argument("--budget", type=int, default=discord_check.CHECK_BUDGET, help="Guild checks started per minute.")
+    parser.add_argument("--pool-size", type=int, default=0, help="Processes indexing large guilds, 0 to index on the event loop.")
+    parser.add_argument("--pool-threshold", type=int, default=20000, help="Member count from which guilds are indexed in the pool.")
+    parser.add_argument("--fuzzy", type=int, default=0, help="Fuzzy matching threshold of the guilds, 0 for exact matching only.")
+    parser.add_argument("--lean", action="store_true", help="Index members as in the lean member cache mode.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator.")
+    return parser.parse_args()
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+
+    print(f"Generating {args.guilds} guilds of {args.members} members...")
+    guilds = {}
+    rosters = {}
+    documents = []
+    for guild_id in range(1, args.guilds + 1):
+        guild, players = make_guild(rng, guild_id, args.members, args.players, args.missing)
+        guilds[guild_id] = guild
+        rosters[f"key-{guild_id}"] = players
+        documents.append({
+            "_id": guild_id,
+            "api_key": f"key-{guild_id}",
+            "alert_channel": 1,
+            "message": "Please join our communication server.",
+            "fuzzy_threshold": args.fuzzy
+        })
+
+    server = FakePRCServer(rosters, latency=args.latency, rate_429=args.rate_429, seed=args.seed)
+    base_url = await server.start()
+
+    executor = ProcessPoolExecutor(args.pool_size) if args.pool_size > 0 else None
+
+    async def make_bot():
+        bot = BenchBot(guilds, MemorySettings([dict(document) for document in documents]), executor, args.pool_threshold, args.lean)
+        bot.prc_api = PRC_API_Client(bot, base_url=base_url, api_key="")
+        await bot.prc_api.start()
+        bot.dispatcher = CommandDispatcher(bot.prc_api, bot.warnings)
+        return bot
+
+    guild_times = []
+
+    async def run_iteration(bot):
+        """
+        Check every guild once through the production path: the scheduler,
+        its request budget, the check semaphore and the cached settings.
+        """
+        guild_times.clear()
+        # Every iteration measures fresh PRC requests
+        bot.prc_api.responses.clear()
+        scheduler = discord_check.scheduler
+        if not scheduler.keys:
+            await discord_check.sync_guilds(bot)
+        start = time.monotonic()
+        for guild_id in scheduler.keys:
+            scheduler.schedule(guild_id, start)
+
+        async def timed_check(guild_id):
+            check_start = time.perf_counter()
+            await discord_check.run_check(bot, guild_id)
+            guild_times.append(time.perf_counter() - check_start)
+
+        tasks = []
+        while len(tasks) < len(scheduler.keys):
+            due = scheduler.pop_due()
+            tasks.extend(asyncio.create_task(timed_check(guild_id)) for guild_id, overdue in due)
+            if not due:
+                # Over budget: the production loop picks the rest up on a later tick.
+                await asyncio.sleep(0.05)
+        await asyncio.gather(*tasks)
+        return sum(1 for guild_id in scheduler.keys if (bot.rosters.activity(guild_id)[2] or 0) >= start)
+
+    def reset_scheduler():
+        discord_check.scheduler = GuildScheduler(
+            discord_check.FULL_CHECK_MINUTES * 60,
+            discord_check.MIN_CHECK_SECONDS,
+            discord_check.MAX_CHECK_MINUTES * 60,
+            args.budget
+        )
+        discord_check.check_semaphore = asyncio.Semaphore(args.concurrency)
+
+    reset_scheduler()
+    bot = await make_bot()
+    memory_bot = None
+    iteration_times = []
+    try:
+        for iteration in range(args.iterations):
+            start = time.perf_counter()
+            checked = await run_iteration(bot)
+            elapsed = time.perf_counter() - start
+            iteration_times.append(elapsed)
+
+            print(
+                f"iteration {iteration + 1}: {elapsed:.3f}s, {checked}/{args.guilds} guilds, "
+                f"{checked / elapsed:.1f} guilds/s, {checked * args.players / elapsed:.0f} players/s, "
+                f"per guild p50 {percentile(guild_times, 50) * 1000:.1f}ms "
+                f"p95 {percentile(guild_times, 95) * 1000:.1f}ms "
+                f"max {max(guild_times, default=0) * 1000:.1f}ms"
+            )
+        pool = bot.prc_api.pool_stats()
+        requests, rate_limited, commands = server.requests, server.rate_limited, server.commands
+
+        # Memory pass: a first iteration of a bot of its own, traced from its creation.
+        tracemalloc.start()
+        reset_scheduler()
+        memory_bot = await make_bot()
+        await run_iteration(memory_bot)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        await bot.prc_api.close()
+        if memory_bot is not None:
+            await memory_bot.prc_api.close()
+        await server.stop()
+        if executor is not None:
+            executor.shutdown()
+
+    print(
+        f"iterations: mean {statistics.mean(iteration_times):.3f}s, "
+        f"min {min(iteration_times):.3f}s, max {max(iteration_times):.3f}s"
+    )
+    print(
+        f"PRC: {requests} requests, {rate_limited} rate limited, {commands} commands, "
+        f"{pool['idle']} pooled connections kept alive"
+    )
+    print(
+        f"memory: {current / 2**20:.1f} MiB traced after a cold iteration, {peak / 2**20:.1f} MiB peak, "
+        f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB max RSS"
+    )
+    print(
+        f"member index: {bot.member_index.member_count()} members, "
+        f"{bot.member_index.memory_usage() / 2**20:.1f} MiB"
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import asyncio
+import random
+import string
+
+from aiohttp import web
+
+
+"""
+This module contains the stand-ins used by the benchmarks: synthetic guilds
+and members, an in-memory settings store with the parts of the
+`Utils.mongo.Document` interface the checker uses, and a local aiohttp
+server that mimics the PRC API.
+"""
+
+PREFIXES = ["", "", "", "[SGT] ", "★ ", "1A-23 | ", "~", "Cpl. ", "(LEO) "]
+SUFFIXES = ["", "", "", " ✓", " | FD", "_", " [Staff]"]
+UNICODE_NOISE = ["é", "ñ", "ø", "ß", "Ω", "🚓"]
+
+
+def random_username(rng, length=None):
+    """
+    Generate a Roblox-like username.
+    :param rng (random.Random): The random generator.
+    :param length (int): The length of the username, random if not given.
+    :return (str): The username.
+    """
+    length = length or rng.randint(4, 16)
+    alphabet = string.ascii_letters + string.digits + "_"
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def noisy(rng, name):
+    """
+    Decorate a name the way members decorate their Discord nicknames.
+    :param rng (random.Random): The random generator.
+    :param name (str): The name.
+    :return (str): The decorated name.
+    """
+    if rng.random() < 0.1:
+        name = name + rng.choice(UNICODE_NOISE)
+    return rng.choice(PREFIXES) + name + rng.choice(SUFFIXES)
+
+
+class FakeMember:
+    __slots__ = ("id", "name", "display_name", "global_name")
+
+    def __init__(self, id, name, display_name, global_name):
+        self.id = id
+        self.name = name
+        self.display_name = display_name
+        self.global_name = global_name
+
+
+class FakeGuild:
+    def __init__(self, id, members):
+        """
+        A class to represent a chunked guild.
+        :param id (int): The ID of the guild.
+        :param members (list[FakeMember]): The members of the guild.
+        """
+        self.id = id
+        self.name = f"Guild {id}"
+        self.icon = None
+        self.members = members
+        self.member_count = len(members)
+        self.chunked = True
+        self.shard_id = 0
+
+    def get_channel(self, channel_id):
+        return None
+
+    def get_member(self, member_id):
+        return None
+
+    async def chunk(self, cache=True):
+        return self.members
+
+
+def make_guild(rng, guild_id, member_count, player_count, missing_ratio):
+    """
+    Generate a guild and the roster of its private server.
+    :param rng (random.Random): The random generator.
+    :param guild_id (int): The ID of the guild.
+    :param member_count (int): The number of Discord members.
+    :param player_count (int): The number of players in the private server.
+    :param missing_ratio (float): The share of players who are not in the Discord server.
+    :return (tuple): The guild and its players, as PRC `server/players` entries.
+    """
+    members = []
+    for i in range(member_count):
+        username = random_username(rng).lower()
+        members.append(FakeMember(
+            # Snowflake sized, distinct across guilds while guild IDs stay below 10**11.
+            10**17 + guild_id * 1_000_000 + i,
+            username,
+            noisy(rng, username if rng.random() < 0.7 else random_username(rng)),
+            noisy(rng, username) if rng.random() < 0.5 else None
+        ))
+
+    players = []
+    for i in range(player_count):
+        if members and rng.random() >= missing_ratio:
+            name = rng.choice(members).name
+        else:
+            name = random_username(rng)
+        players.append({
+            "Player": f"{name}:{guild_id * 1_000 + i}",
+            "Permission": "Normal",
+            "Callsign": None,
+            "Team": rng.choice(["Civilian", "Police", "Sheriff", "Fire", "DOT"])
+        })
+
+    return FakeGuild(guild_id, members), players
+
+
+class MemoryCursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class MemoryCollection:
+    def __init__(self, documents):
+        """
+        A class to represent a MongoDB collection held in memory.
+        Queries only support equality and `$exists` on top-level fields.
+        :param documents (list[dict]): The documents of the collection.
+        """
+        self.name = "settings"
+        self.documents = {document["_id"]: document for document in documents}
+
+    @staticmethod
+    def _matches(document, query):
+        for key, value in (query or {}).items():
+            if isinstance(value, dict) and "$exists" in value:
+                if (key in document) != value["$exists"]:
+                    return False
+            elif isinstance(value, dict):
+                continue
+            elif document.get(key) != value:
+                return False
+        return True
+
+    def find(self, query=None, projection=None, **kwargs):
+        documents = [document for document in self.documents.values() if self._matches(document, query)]
+        if projection:
+            documents = [
+                {key: value for key, value in document.items() if key == "_id" or projection.get(key)}
+                for document in documents
+            ]
+        return MemoryCursor(documents)
+
+    async def find_one(self, query, projection=None):
+        for document in self.documents.values():
+            if self._matches(document, query):
+                return document
+        return None
+
+
+class MemorySettings:
+    def __init__(self, documents):
+        """
+        A class with the parts of the `Utils.mongo.Document` interface used by the checker.
+        :param documents (list[dict]): The settings documents.
+        """
+        self.db = MemoryCollection(documents)
+
+    async def get(self, id):
+        return self.db.documents.get(id)
+
+    async def find_by_id(self, id):
+        return self.db.documents.get(id)
+
+    async def update_by_id(self, document):
+        self.db.documents.setdefault(document["_id"], {}).update(document)
+
+    async def upsert(self, document):
+        await self.update_by_id(document)
+
+    def queue_update(self, id, update, upsert=True):
+        document = self.db.documents.get(id)
+        if document is None:
+            if not upsert:
+                return
+            document = self.db.documents.setdefault(id, {"_id": id})
+        document.update(update.get("$set", {}))
+        for field, value in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + value
+
+    async def flush(self):
+        return []
+
+    def iter(self, query=None, projection=None, batch_size=100):
+        return self.db.find(query, projection)
+
+
+class FakePRCServer:
+    def __init__(self, rosters, latency=0.0, rate_429=0.0, seed=0, retry_after=0.05):
+        """
+        A class to represent a local stand-in for the PRC API.
+        :param rosters (dict): Server key -> `server/players` entries.
+        :param latency (float): The number of seconds each response is delayed by.
+        :param rate_429 (float): The share of requests answered with a 429.
+        :param seed (int): The seed of the random generator.
+        :param retry_after (float): The number of seconds sent back in the Retry-After header of a 429.
+        """
+        self.rosters = rosters
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.rate_limited = 0
+        self.commands = 0
+        self._runner = None
+        self.url = None
+
+    async def _delay(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rng.random() < self.rate_429:
+            self.rate_limited += 1
+            return web.json_response(
+                {"message": "You are being rate limited!", "retry_after": self.retry_after},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)}
+            )
+        return None
+
+    async def players(self, request):
+        limited = await self._delay(request)
+        if limited is not None:
+            return limited
+        roster = self.rosters.get(request.headers.get("Server-Key"))
+        if roster is None:
+            return web.json_response({"message": "Forbidden"}, status=403)
+        return web.json_response(roster)
+
+    async def join_logs(self, request):
+        limited = await self._delay(request)
+        if limited is not None:
+            return limited
+        return web.json_response([])
+
+    async def command(self, request):
+        limited = await self._delay(request)
+        if limited is not None:
+            return limited
+        self.commands += 1
+        return web.json_response({"message": "Success"})
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Start the server.
+        :param host (str): The host to listen on.
+        :param port (int): The port to listen on, any free port if 0.
+        :return (str): The base URL of the server.
+        """
+        app = web.Application()
+        app.router.add_get("/server/players", self.players)
+        app.router.add_get("/server/joinlogs", self.join_logs)
+        app.router.add_post("/server/command", self.command)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        """
+        Stop the server.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
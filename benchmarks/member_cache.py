@@ -0,0 +1,104 @@
+import argparse
+import gc
+import random
+import tracemalloc
+
+import discord
+from discord.state import ConnectionState
+
+from Utils.member_index import MemberNameIndex
+from benchmarks.fakes import make_guild
+
+
+"""
+Report on the memory saved by the lean member cache mode.
+
+Builds the same synthetic members as discord.py cached members and as the
+member name index, and compares the memory each one holds. In the default
+mode the bot keeps both; in lean mode it only keeps the index. With
+--fuzzy, the index also keeps the name tokens fuzzy matching needs.
+
+    python -m benchmarks.member_cache --guilds 10 --members 20000
+"""
+
+def member_payload(member):
+    return {
+        "user": {
+            "id": str(member.id),
+            "username": member.name,
+            "discriminator": "0",
+            "global_name": member.global_name,
+            "avatar": None
+        },
+        "nick": member.display_name if member.display_name != member.name else None,
+        "roles": [],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0
+    }
+
+
+def traced(build):
+    """
+    Measure the memory still held by what a function builds.
+    :param build (callable): The function, whose result is kept alive while measuring.
+    :return (int): The number of bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the memory of the member cache and the member name index.")
+    parser.add_argument("--guilds", type=int, default=10, help="Number of guilds.")
+    parser.add_argument("--members", type=int, default=20000, help="Members per guild.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator.")
+    parser.add_argument("--fuzzy", action="store_true", help="Index the guilds as using fuzzy matching.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    guilds = [make_guild(rng, i + 1, args.members, 0, 0)[0] for i in range(args.guilds)]
+    total = args.guilds * args.members
+
+    def build_cache():
+        state = ConnectionState(
+            dispatch=lambda *args: None, handlers={}, hooks={}, http=None,
+            intents=discord.Intents.default() | discord.Intents(members=True),
+            member_cache_flags=discord.MemberCacheFlags.all(),
+            chunk_guilds_at_startup=False
+        )
+        cached = []
+        for fake in guilds:
+            guild = discord.Guild(data={"id": str(fake.id), "name": fake.name}, state=state)
+            for member in fake.members:
+                guild._add_member(discord.Member(data=member_payload(member), guild=guild, state=state))
+            cached.append(guild)
+        return state, cached
+
+    def build_index():
+        index = MemberNameIndex()
+        for guild in guilds:
+            index.use_fuzzy(guild.id, args.fuzzy)
+            index.build(guild.id, guild.members)
+        return index
+
+    cache = traced(build_cache)
+    index = traced(build_index)
+    print(f"{args.guilds} guilds, {total} members")
+    print(f"discord.py member cache: {cache / 2**20:.1f} MiB, {cache / total:.0f} bytes per member")
+    print(f"member name index: {index / 2**20:.1f} MiB, {index / total:.0f} bytes per member")
+    print(f"lean mode saves {cache / 2**20:.1f} MiB ({cache / (cache + index):.0%} of member memory)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import time
+
+from Utils import prc
+from Utils.prc import PRC_API_Client
+from benchmarks.fakes import FakePRCServer, MemorySettings
+
+
+"""
+Check of the PRC client's handling of 429 responses, against the local
+stand-in for the PRC API.
+
+Asserts that rate limited requests are retried only after the Retry-After
+delay sent by the API, and that ResponseFailed is raised with code 429 once
+PRC_MAX_RETRIES retries are exhausted.
+
+    python -m benchmarks.retry_check
+"""
+
+SERVER_KEY = "retry-check"
+GUILD_ID = 1
+ROSTER = [{"Player": "Player1:1", "Permission": "Normal", "Callsign": None, "Team": "Civilian"}]
+
+
+class RetryBot:
+    def __init__(self):
+        """
+        A class with the parts of the Bot used by the PRC client.
+        """
+        self.settings = MemorySettings([{"_id": GUILD_ID, "api_key": SERVER_KEY}])
+
+
+async def fetch(server, max_retries):
+    """
+    Fetch the players of the test server through a new client.
+    :param server (FakePRCServer): The running server.
+    :param max_retries (int): The number of retries allowed.
+    :return (tuple): The players, or the ResponseFailed raised, and the number of seconds taken.
+    """
+    client = PRC_API_Client(RetryBot(), base_url=server.url, api_key="")
+    client.max_retries = max_retries
+    await client.start()
+    start = time.perf_counter()
+    try:
+        result = await client._fetch_server_players(GUILD_ID)
+    except prc.ResponseFailed as e:
+        result = e
+    finally:
+        await client.close()
+    return result, time.perf_counter() - start
+
+
+async def check_retried(retry_after, max_retries, seed):
+    server = FakePRCServer({SERVER_KEY: ROSTER}, rate_429=0.5, seed=seed, retry_after=retry_after)
+    await server.start()
+    try:
+        result, elapsed = await fetch(server, max_retries=max_retries)
+    finally:
+        await server.stop()
+
+    assert not isinstance(result, prc.ResponseFailed), f"request failed after {server.rate_limited} 429s: {result}"
+    assert [player.name for player in result] == ["Player1"], result
+    assert server.requests == server.rate_limited + 1, (server.requests, server.rate_limited)
+    # Every 429 blocks the server key for Retry-After seconds
+    assert elapsed >= server.rate_limited * retry_after, (elapsed, server.rate_limited)
+    print(f"retried: {server.rate_limited} 429s, succeeded after {elapsed:.2f}s")
+
+
+async def check_exhausted(retry_after, max_retries):
+    server = FakePRCServer({SERVER_KEY: ROSTER}, rate_429=1.0, retry_after=retry_after)
+    await server.start()
+    try:
+        result, elapsed = await fetch(server, max_retries=max_retries)
+    finally:
+        await server.stop()
+
+    assert isinstance(result, prc.ResponseFailed), f"expected ResponseFailed, got {result!r}"
+    assert result.code == 429, result.code
+    assert server.requests == max_retries + 1, (server.requests, max_retries)
+    # The last 429 is not waited for, since no retry is left
+    assert elapsed >= max_retries * retry_after, (elapsed, max_retries)
+    print(f"exhausted: ResponseFailed(code=429) after {server.requests} requests in {elapsed:.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check the retries of the PRC client on 429 responses.")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="Seconds sent in the Retry-After header.")
+    parser.add_argument("--max-retries", type=int, default=3, help="Retries allowed per request.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the random generator.")
+    return parser.parse_args()
+
+
+async def run(args):
+    await check_retried(args.retry_after, args.max_retries, args.seed)
+    await check_exhausted(args.retry_after, args.max_retries)
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+import requests
+from decouple import config
+from dotenv import load_dotenv
+
+from Utils.cluster import shard_ranges
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [CLUSTER] %(message)s")
+
+"""
+Cluster coordinator: runs the bot as several worker processes, each owning a
+contiguous range of shards and only checking the guilds in those shards.
+
+    python cluster.py
+
+CLUSTER_WORKERS sets the number of workers, TOTAL_SHARDS the number of
+shards (Discord's recommendation is used when it is not set). Workers that
+exit are restarted. On SIGINT or SIGTERM, workers are sent SIGTERM, which
+closes them cleanly, and killed if they are still running after
+CLUSTER_STOP_TIMEOUT seconds. With METRICS_PORT set, worker N serves its metrics on
+METRICS_PORT + N.
+"""
+
+def recommended_shards(token):
+    """
+    Get the number of shards recommended by Discord.
+    :param token (str): The bot token.
+    :return (int): The number of shards.
+    """
+    resp = requests.get(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}"},
+        timeout=10
+    )
+    resp.raise_for_status()
+    return resp.json()["shards"]
+
+
+def run_worker(index, shard_ids, shard_count):
+    """
+    Run a worker process.
+    :param index (int): The index of the worker.
+    :param shard_ids (list[int]): The shards of the worker.
+    :param shard_count (int): The total number of shards.
+    """
+    # Ctrl+C reaches the whole process group: leave it to the coordinator, which sends
+    # SIGTERM, so the worker is not interrupted a second time while it is closing.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    metrics_port = config('METRICS_PORT', default=0, cast=int)
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(metrics_port + index)
+
+    import main
+    main.run(shard_ids, shard_count)
+
+
+def start_worker(context, index, shard_ids, shard_count):
+    process = context.Process(
+        target=run_worker,
+        args=(index, shard_ids, shard_count),
+        name=f"worker-{index}",
+        daemon=False
+    )
+    process.start()
+    logging.info(f"Started worker {index} (pid {process.pid}) for shards {shard_ids[0]}-{shard_ids[-1]}")
+    return process
+
+
+def main():
+    shard_count = config('TOTAL_SHARDS', default=0, cast=int) or recommended_shards(os.getenv('BOT_TOKEN'))
+    workers = config('CLUSTER_WORKERS', default=os.cpu_count() or 1, cast=int)
+    ranges = shard_ranges(shard_count, workers)
+    logging.info(f"Running {shard_count} shards on {len(ranges)} workers")
+
+    # spawn, so workers don't inherit the coordinator's state
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    for index, shard_ids in enumerate(ranges):
+        processes[index] = start_worker(context, index, shard_ids, shard_count)
+        # Shards must identify one at a time; stagger workers so they don't all queue up at once.
+        time.sleep(config('CLUSTER_START_DELAY', default=5, cast=float))
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        time.sleep(5)
+        for index, process in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                logging.warning(f"Worker {index} exited with code {process.exitcode}, restarting")
+                processes[index] = start_worker(context, index, ranges[index], shard_count)
+
+    # Workers flush their queued writes while closing, give them time to finish.
+    deadline = time.monotonic() + config('CLUSTER_STOP_TIMEOUT', default=30, cast=float)
+    for index, process in processes.items():
+        process.join(timeout=max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            logging.warning(f"Worker {index} did not stop in time, killing it")
+            process.kill()
+            process.join()
+    logging.info("All workers stopped")
+
+
+if __name__ == "__main__":
+    main()
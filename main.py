@@ -3,18 +3,33 @@ from discord.abc import User
 from discord.ext import commands, tasks
 
 from pkgutil import iter_modules
+import hashlib
+import json
 import logging
 import os
+import signal
 import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from dotenv import load_dotenv
 import motor.motor_asyncio
 
 from Utils.prc import PRC_API_Client
-from Utils.mongo import Document
+from Utils.mongo import Document, CachedDocument
+from Utils.member_index import MemberNameIndex
+from Utils.roster import RosterTracker
+from Utils.links import LinkStore, MATCHED
+from Utils.dispatcher import CommandDispatcher
+from Utils.alerts import AlertSink
+from Utils.warning_history import WarningHistory
+from Utils import metrics
+from Utils.cluster import shard_query
+from Utils.scheduler import fan_out
 from decouple import config
 
-from Tasks.discord_check import discord_checks
+from Tasks.discord_check import discord_checks, join_log_checks, JOINLOG_INTERVAL, LINKED_GUILDS, SCAN_BATCH_SIZE
 
 load_dotenv()
 
@@ -28,10 +43,28 @@ intents.bans = True
 
 discord.utils.setup_logging(level=logging.INFO)
 
+# Keep members only in the compact name index instead of discord.py's member cache.
+LEAN_MEMBER_CACHE = config('LEAN_MEMBER_CACHE', default=False, cast=bool)
+# Number of linked guilds chunked at once after a shard is ready
+CHUNK_CONCURRENCY = config('CHUNK_CONCURRENCY', default=5, cast=int)
+CHUNK_TIMEOUT = config('CHUNK_TIMEOUT', default=120, cast=float)
+
 class Bot(commands.AutoShardedBot):
     
     async def close(self):
         print('Closing...')
+        if isinstance(self.settings, CachedDocument):
+            self.settings.stop_watching()
+            await self.settings.close()
+        await self.links.document.close()
+        await self.warnings.document.close()
+        await self.check_stats.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.prc_api is not None:
+            await self.prc_api.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
         await super().close()
         print('Closed!')
         
@@ -40,32 +73,269 @@ class Bot(commands.AutoShardedBot):
             self.mongo = motor.motor_asyncio.AsyncIOMotorClient(os.getenv('MONGO_URI'))
             self.db = self.mongo["erlc_checker"]
             self.settings = self.db["settings"]
+            pool_size = config('MATCH_POOL_SIZE', default=2, cast=int)
+            self.executor = ProcessPoolExecutor(
+                max_workers=pool_size,
+                mp_context=multiprocessing.get_context("spawn")
+            ) if pool_size > 0 else None
+            self.member_index = MemberNameIndex(
+                executor=self.executor,
+                threshold=config('MATCH_POOL_THRESHOLD', default=20000, cast=int),
+                lean=LEAN_MEMBER_CACHE,
+                # Nickname updates of uncached members are not dispatched, so lean indexes are rebuilt periodically.
+                refresh=config('LEAN_REFRESH_MINUTES', default=30, cast=float) * 60 if LEAN_MEMBER_CACHE else 0,
+                max_candidates=config('FUZZY_MAX_CANDIDATES', default=50, cast=int)
+            )
+            self.links = LinkStore(
+                Document(self.db, 'links'),
+                retention=config('MATCHED_LINK_DAYS', default=30, cast=float) * 86400,
+                maxsize=config('MATCHED_LINK_CACHE_SIZE', default=200000, cast=int)
+            )
+            self.warnings = WarningHistory(
+                Document(self.db, 'warnings'),
+                cooldown=config('WARNING_COOLDOWN', default=300, cast=int),
+                escalate_after=config('WARNING_ESCALATE_AFTER', default=3, cast=int),
+                retention=config('WARNING_HISTORY_DAYS', default=7, cast=float) * 86400,
+                maxsize=config('WARNING_HISTORY_SIZE', default=200000, cast=int)
+            )
+            self.rosters = RosterTracker(self.member_index, self.links)
+            self.shards_ready = set()
+            self.metrics_server = None
+            self.prc_api = None
+            self.meta = Document(self.db, 'meta')
+            # guild_id -> last check stats and join log watermark, written on every check
+            self.check_stats = Document(self.db, 'check_stats')
+            self.cache_ready = asyncio.Event()
+            self.background_tasks = set()
 
-    async def setup_hook(self) -> None:
-        self.prc_api = PRC_API_Client(self, base_url=config('PRC_API_URL'), api_key=config('PRC_API_KEY'))
-        self.settings = Document(self.db, 'settings')
-        
-        Extensions = [m.name for m in iter_modules(['Cogs'],prefix='Cogs.')]
+    def settings_query(self, query=None):
+        """
+        Restrict a settings query to the guilds of the shards run by this process.
+        :param query (dict): The query to restrict.
+        :return (dict): The restricted query.
+        """
+        query = dict(query or {})
+        if self.shard_ids is not None:
+            query.update(shard_query(self.shard_ids, self.shard_count))
+        return query
+
+    def stop(self):
+        """
+        Close the bot from a signal handler.
+        """
+        if not self.is_closed():
+            logging.info("Received SIGTERM, closing")
+            self.spawn(self.close())
+
+    def spawn(self, coro):
+        """
+        Run a coroutine in the background, keeping a reference to its task until it is done.
+        :param coro (coroutine): The coroutine.
+        :return (asyncio.Task): The task.
+        """
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+
+        def done(task):
+            self.background_tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logging.error("Background task failed", exc_info=task.exception())
 
-        for extension in Extensions:
+        task.add_done_callback(done)
+        return task
+
+    async def chunk_guild(self, guild):
+        """
+        Make the members of a guild available to the checks: chunk them if
+        they have not been, and build their name index.
+        :param guild (discord.Guild): The guild.
+        """
+        async def chunk():
+            if not self.member_index.lean and not guild.chunked:
+                await guild.chunk()
+            await self.member_index.ensure(guild)
+        await asyncio.wait_for(chunk(), timeout=CHUNK_TIMEOUT)
+
+    async def chunk_linked_guilds(self, shard_id):
+        """
+        Chunk the linked guilds of a shard, a few at a time.
+        Guilds are not chunked at startup, so unlinked guilds are never chunked at all.
+        :param shard_id (int): The ID of the shard.
+        """
+        start = time.perf_counter()
+
+        async def linked_guilds():
+            projection = {"guild_id": 1, "fuzzy_threshold": 1}
+            async for guild_data in self.settings.iter(self.settings_query(LINKED_GUILDS), projection, SCAN_BATCH_SIZE):
+                guild = self.get_guild(int(guild_data.get("guild_id") or guild_data["_id"]))
+                if guild is not None and guild.shard_id == shard_id:
+                    # Indexed with the name tokens fuzzy matching needs, if it uses it.
+                    self.member_index.use_fuzzy(guild.id, guild_data.get("fuzzy_threshold", 0) > 0)
+                    yield guild
+
+        results = await fan_out(linked_guilds(), self.chunk_guild, CHUNK_CONCURRENCY)
+        failed = sum(1 for result in results if isinstance(result, BaseException))
+        logging.info(
+            f"Chunked {len(results) - failed} linked guilds of shard {shard_id} "
+            f"in {time.perf_counter() - start:.2f} seconds, {failed} failed"
+        )
+
+    async def on_shard_ready(self, shard_id):
+        # Guilds are not chunked at startup: the linked ones are chunked in
+        # the background, and checks chunk any guild still missing on demand.
+        self.shards_ready.add(shard_id)
+        # `self.shards` only holds the shards launched so far, so compare
+        # against every shard this process runs instead.
+        expected = set(self.shard_ids if self.shard_ids is not None else range(self.shard_count or 1))
+        logging.info(f"Shard {shard_id} ready ({len(self.shards_ready & expected)}/{len(expected)})")
+        self.spawn(self.chunk_linked_guilds(shard_id))
+        if self.shards_ready >= expected:
+            self.cache_ready.set()
+
+    async def load_extensions(self):
+        """
+        Load every extension in the Cogs folder concurrently.
+        """
+        async def load(extension):
             try:
                 await self.load_extension(extension)
                 logging.info(f'Loaded extension {extension}.')
             except Exception as e:
                 logging.error(f'Failed to load extension {extension}.', exc_info=True)
 
+        Extensions = [m.name for m in iter_modules(['Cogs'],prefix='Cogs.')]
+        await asyncio.gather(*(load(extension) for extension in Extensions))
 
-        logging.info("Loaded all extensions.")
+    def command_tree_hash(self):
+        """
+        Hash the global application commands, to tell if they changed since the last sync.
+        :return (str): The hash of the commands.
+        """
+        commands_data = sorted(
+            json.dumps(command.to_dict(self.tree), sort_keys=True, default=str)
+            for command in self.tree.get_commands()
+        )
+        return hashlib.sha256("\n".join(commands_data).encode()).hexdigest()
+
+    async def sync_command_tree(self):
+        """
+        Sync the global application commands, unless they are unchanged since the last sync.
+        The hash of the last synced commands is kept in the database, per application.
+        """
+        start = time.perf_counter()
+        key = f"command_tree:{self.application_id}"
+        command_hash = self.command_tree_hash()
+        synced = await self.meta.find_by_id(key)
+        if synced and synced.get("hash") == command_hash:
+            logging.info("Command tree unchanged, skipping sync")
+            return
+
+        await self.tree.sync()
+        await self.meta.upsert({"_id": key, "hash": command_hash})
+        logging.info(f"Synced the command tree in {time.perf_counter() - start:.2f} seconds")
+
+    async def setup_hook(self) -> None:
+        timings = {}
+        phase_start = startup_start = time.perf_counter()
+
+        def phase(name):
+            nonlocal phase_start
+            now = time.perf_counter()
+            timings[name] = now - phase_start
+            phase_start = now
+
+        try:
+            # SIGTERM (the cluster coordinator, process managers) closes the bot like Ctrl+C does,
+            # so the queued writes are flushed before the process exits.
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+        except NotImplementedError:
+            # Signal handlers are not supported by the event loops on Windows.
+            pass
 
+        self.prc_api = PRC_API_Client(self, base_url=config('PRC_API_URL'), api_key=config('PRC_API_KEY'))
+        await self.prc_api.start()
+        metrics.register_http_pool(self.prc_api)
+        metrics.register_cache("prc_responses", self.prc_api.responses)
+        self.dispatcher = CommandDispatcher(
+            self.prc_api,
+            self.warnings,
+            max_length=config('COMMAND_MAX_LENGTH', default=200, cast=int)
+        )
+        metrics.register_cache("warning_history", self.warnings.records)
+        phase("clients")
+
+        self.settings = CachedDocument(
+            self.db, 'settings',
+            ttl=config('SETTINGS_CACHE_TTL', default=300, cast=int),
+            maxsize=config('SETTINGS_CACHE_SIZE', default=10000, cast=int)
+        )
+        self.settings.watch()
+        write_interval = config('WRITE_BEHIND_SECONDS', default=5.0, cast=float)
+        write_batch = config('WRITE_BEHIND_BATCH', default=1000, cast=int)
+        self.settings.write_behind(write_interval, write_batch)
+        self.links.document.write_behind(write_interval, write_batch)
+        self.warnings.document.write_behind(write_interval, write_batch)
+        self.check_stats.write_behind(write_interval, write_batch)
+        metrics.register_cache("settings", self.settings.cache)
+        self.alerts = AlertSink(
+            self.settings,
+            rate=config('ALERT_EDIT_RATE', default=0.2, cast=float),
+            capacity=config('ALERT_EDIT_BURST', default=1, cast=int)
+        )
+        metrics.REGISTRY.add_collector(lambda: metrics.MEMBERS_INDEXED.set(self.member_index.member_count()))
+        await asyncio.gather(
+            # Backs the linked guild filter of the check loops.
+            self.settings.create_index(
+                [("api_key", 1), ("alert_channel", 1)],
+                name="linked_guilds",
+                partialFilterExpression=LINKED_GUILDS
+            ),
+            # Expires the links matched by name after their retention; verified links are kept.
+            self.links.document.create_ttl_index(
+                "linked_at",
+                int(self.links.retention),
+                "matched_link_ttl",
+                partialFilterExpression={"source": MATCHED}
+            ),
+            self.links.load(self.settings_query()),
+            # Expires warning records after the retention of the in-memory history.
+            self.warnings.document.create_ttl_index("updated_at", int(self.warnings.retention), "warning_ttl"),
+            self.warnings.load(self.settings_query())
+        )
         logging.info("Connected to MongoDB")
+        phase("mongo")
+
+        metrics_port = config('METRICS_PORT', default=0, cast=int)
+        if metrics_port:
+            self.metrics_server = metrics.MetricsServer(config('METRICS_HOST', default='127.0.0.1'), metrics_port)
+            await self.metrics_server.start()
+        phase("metrics")
+
+        await self.load_extensions()
+        logging.info("Loaded all extensions.")
+        phase("extensions")
 
         change_status.start()
         discord_checks.start(self)
+        if JOINLOG_INTERVAL > 0:
+            join_log_checks.start(self)
+        phase("tasks")
 
         logging.info(f"Logged in as {bot.user}")
 
-        await bot.tree.sync()
+        # In cluster mode, only the worker running shard 0 syncs the global command tree.
+        # It does not hold up the connection to the gateway.
+        if self.shard_ids is None or 0 in self.shard_ids:
+            self.spawn(self.sync_command_tree())
+
+        breakdown = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        logging.info(f"Setup done in {time.perf_counter() - startup_start:.2f} seconds ({breakdown})")
+
 
+lean_options = {}
+if LEAN_MEMBER_CACHE:
+    # Guilds are chunked without caching by the member index.
+    lean_options = dict(member_cache_flags=discord.MemberCacheFlags.none())
 
 bot = Bot(
     command_prefix='d!',
@@ -73,6 +343,9 @@ bot = Bot(
     intents=intents,
     help_command=None,
     allowed_mentions=discord.AllowedMentions(everyone=False, roles=False, users=True),
+    # Only linked guilds are chunked, see Bot.chunk_linked_guilds.
+    chunk_guilds_at_startup=False,
+    **lean_options
 )
 
 
@@ -94,11 +367,20 @@ def bot_ready():
 
 bot_token = os.getenv('BOT_TOKEN')
 
-def run():
+def run(shard_ids=None, shard_count=None):
+    """
+    Run the bot.
+    :param shard_ids (list[int]): The shards run by this process, all of them if not given.
+    :param shard_count (int): The total number of shards, required with `shard_ids`.
+    """
+    if shard_ids is not None:
+        bot.shard_ids = shard_ids
+        bot.shard_count = shard_count
+        logging.info(f"Running shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}")
     try:
         bot.run(bot_token)
     except Exception as e:
         logging.error(f"Error: {e}", exc_info=True)
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
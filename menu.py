@@ -17,12 +17,14 @@ class ConfigurationMenu(discord.ui.View):
             role_id = self.sett.get("role_id", 0)
             message = self.sett.get("message", "You are not in the communication server. Please join it.")
             minimum_players = self.sett.get("minimum_players", 0)
+            fuzzy_threshold = self.sett.get("fuzzy_threshold", 0)
         except KeyError:
             alert_channel = 0
             api_key = 0
             role_id = 0
             message = "You are not in the communication server. Please join it."
             minimum_players = 0
+            fuzzy_threshold = 0
 
         self.alert_channel = discord.ui.ChannelSelect(
             placeholder="Select the alert channel",
@@ -44,13 +46,21 @@ class ConfigurationMenu(discord.ui.View):
             row=2
         )
 
+        self.fuzzy_button = discord.ui.Button(
+            label="Fuzzy Matching",
+            style=discord.ButtonStyle.secondary,
+            row=2
+        )
+
         self.alert_channel.callback = self.alert_channel_callback
         self.minimum_player_button.callback = self.minimum_players_callback
         self.message_button.callback = self.message_button_callback
+        self.fuzzy_button.callback = self.fuzzy_button_callback
 
         self.add_item(self.alert_channel)
         self.add_item(self.minimum_player_button)
         self.add_item(self.message_button)
+        self.add_item(self.fuzzy_button)
 
     async def alert_channel_callback(self, interaction):
         if interaction.user.id != self.user_id:
@@ -168,6 +178,17 @@ class ConfigurationMenu(discord.ui.View):
                 )
             )
 
+        if len(response.content) > self.bot.dispatcher.max_message_length:
+            await response.delete()
+            return await interaction.followup.send(
+                embed=discord.Embed(
+                    title="Message Too Long",
+                    description=f"The message cannot be longer than {self.bot.dispatcher.max_message_length} characters.",
+                    color=BLANK_COLOR
+                ),
+                ephemeral=True
+            )
+
         self.sett["message"] = response.content
         await self.bot.settings.update_by_id(
             {
@@ -186,6 +207,73 @@ class ConfigurationMenu(discord.ui.View):
             ephemeral=True
         )
 
+    async def fuzzy_button_callback(self, interaction):
+        if interaction.user.id != self.user_id:
+            return await interaction.response.send_message(
+                embed=discord.Embed(
+                    title="Not Permitted",
+                    description="You cannot configure this setting.",
+                    color=BLANK_COLOR
+                ),
+                ephemeral=True
+            )
+
+        await interaction.response.send_message(
+            embed=discord.Embed(
+                title="Fuzzy Matching",
+                description="Please provide how many characters a Discord name may differ from a Roblox username and still match (0 to 3, 0 disables fuzzy matching).",
+                color=BLANK_COLOR
+            ),
+            ephemeral=True
+        )
+
+        try:
+            response = await self.bot.wait_for(
+                "message",
+                check=lambda m: m.author.id == self.user_id,
+                timeout=60
+            )
+        except asyncio.TimeoutError:
+            return await interaction.followup.send(
+                embed=discord.Embed(
+                    title="Timeout",
+                    description="You took too long to provide the threshold.",
+                    color=BLANK_COLOR
+                )
+            )
+
+        try:
+            fuzzy_threshold = int(response.content)
+        except ValueError:
+            fuzzy_threshold = -1
+        if not 0 <= fuzzy_threshold <= 3:
+            return await interaction.followup.send(
+                embed=discord.Embed(
+                    title="Invalid Threshold",
+                    description="The threshold must be a number from 0 to 3.",
+                    color=BLANK_COLOR
+                ),
+                ephemeral=True
+            )
+
+        self.sett["fuzzy_threshold"] = fuzzy_threshold
+        await self.bot.settings.update_by_id(
+            {
+                "_id": self.sett["_id"],
+                "fuzzy_threshold": fuzzy_threshold
+            }
+        )
+        await response.delete()
+
+        await interaction.followup.send(
+            embed=discord.Embed(
+                title="Fuzzy Matching Updated",
+                description="The fuzzy matching threshold has been updated.",
+                color=BLANK_COLOR
+            ),
+            ephemeral=True
+        )
+
     
 async def setup(bot):
     await bot.add_cog(ConfigurationMenu(bot))
\ No newline at end of file